@@ -1,5 +1,19 @@
+import collections
+import hashlib
+import os
+import tempfile
+import typing as T
+
 import numpy as np
 import math
+import xarray as xr
+
+
+def fft_length(nt: int) -> int:
+    """
+    Half length nfft of the extended series of a series of **nt** time steps (smallest power of 2 not below nt).
+    """
+    return 2 ** (math.ceil(math.log2(abs(nt))))
 
 
 def compute_susceptibility(
@@ -13,8 +27,7 @@ def compute_susceptibility(
 
     green_function = np.diff(series)
 
-    nt = len(series)
-    nfft = 2 ** (math.ceil(math.log2(abs(nt))))
+    nfft = fft_length(len(series))
 
     green_function_extd = np.zeros(2 * nfft)
     green_function_extd[0:len(green_function)] = green_function
@@ -32,11 +45,11 @@ def compute_response(
     """
     Compute response to **forcing** given extended susceptibility **chi**
     :param chi: extended susceptibility
-    :param forcing: forcing function (from lab.forcings)
+    :param forcing: Forcing instance (from lab.simulation.forcings)
     :return:
     """
     nfft = int(len(chi)/2)
-    f = [forcing(t*0.01) - 8 for t in np.arange(0, nfft)]
+    f = forcing.evaluate(np.arange(0, nfft)*0.01) - 8
 
     f_extd = np.zeros(2 * nfft)
     f_extd[nfft:(nfft + len(f))] = f
@@ -45,4 +58,233 @@ def compute_response(
 
     resp = np.fft.ifft(chi * (F_extd))
 
-    return np.real(resp)
\ No newline at end of file
+    return np.real(resp)
+
+
+def compute_susceptibilities(
+        series: np.ndarray,
+        nfft: int = None,
+) -> np.ndarray:
+    """
+    Compute the susceptibilities of a stack of responses to unit step forcing at once, as compute_susceptibility
+    but with a real FFT along the last axis: only the nfft + 1 non-negative frequencies are returned (the others are
+    their complex conjugates).
+    :param series: responses to unit step forcing, (... x time), e.g. (observables x time)
+    :param nfft: half length of the extended series (at least the length of the series). If None, the smallest
+    power of 2 not below the length of the series, as compute_susceptibility.
+    :return: extended susceptibilities, (... x nfft + 1)
+    """
+    series = np.asarray(series, dtype=np.float64)
+    nt = series.shape[-1]
+    if nfft is None:
+        nfft = fft_length(nt)
+    elif nfft < nt:
+        raise ValueError('nfft ({}) shorter than the series ({})'.format(nfft, nt))
+
+    # green function placed at [nfft, nfft + nt - 1), as compute_susceptibility after np.roll
+    green_function_extd = np.zeros(series.shape[:-1] + (2 * nfft,))
+    green_function_extd[..., nfft:nfft + nt - 1] = np.diff(series, axis=-1)
+
+    return np.fft.rfft(green_function_extd, axis=-1)
+
+
+def compute_forcing_spectra(
+        forcings: list,
+        nfft: int,
+        increment: float = 0.01,
+        base_intensity: float = 8,
+) -> np.ndarray:
+    """
+    Compute the real FFT of the extended perturbation (forcing - **base_intensity**) of many forcings at once, as
+    in compute_response.
+    :param forcings: Forcing instances (from lab.simulation.forcings)
+    :param nfft: half length of the extended series (see compute_susceptibilities)
+    :param increment: time between samples of the forcing
+    :param base_intensity: unperturbed forcing
+    :return: spectra, (forcings x nfft + 1)
+    """
+    times = np.arange(0, nfft) * increment
+
+    f_extd = np.zeros((len(forcings), 2 * nfft))
+    for i, forcing in enumerate(forcings):
+        f_extd[i, nfft:] = forcing.evaluate(times) - base_intensity
+
+    return np.fft.rfft(f_extd, axis=-1)
+
+
+def compute_responses(
+        chi: np.ndarray,
+        forcings,
+        length: int = None,
+        increment: float = 0.01,
+        base_intensity: float = 8,
+) -> np.ndarray:
+    """
+    Predict the responses of many observables to many forcings at once, as compute_response but with real FFTs.
+    Observables are processed one at a time, so that memory holds the output and one (forcings x 2 * nfft) block.
+    :param chi: extended susceptibilities, (observables x nfft + 1), from compute_susceptibilities
+    :param forcings: Forcing instances, or their spectra (forcings x nfft + 1) from compute_forcing_spectra
+    :param length: number of time steps returned. If None, the whole 2 * nfft extended series, as compute_response.
+    :param increment: time between samples of the forcing (ignored if spectra are given)
+    :param base_intensity: unperturbed forcing (ignored if spectra are given)
+    :return: responses, (observables x forcings x time)
+    """
+    chi = np.atleast_2d(chi)
+    nfft = chi.shape[-1] - 1
+
+    if isinstance(forcings, np.ndarray):
+        spectra = np.atleast_2d(forcings)
+    else:
+        spectra = compute_forcing_spectra(forcings, nfft, increment, base_intensity)
+    if spectra.shape[-1] != chi.shape[-1]:
+        raise ValueError('forcing spectra have {} frequencies, susceptibilities {}'.format(
+            spectra.shape[-1], chi.shape[-1]
+        ))
+
+    length = 2 * nfft if length is None else length
+    resp = np.empty((chi.shape[0], spectra.shape[0], length))
+    for i in range(chi.shape[0]):
+        resp[i] = np.fft.irfft(chi[i] * spectra, n=2 * nfft, axis=-1)[:, :length]
+
+    return resp
+
+
+def file_hash(path: str) -> str:
+    """
+    SHA-1 of the content of the file at **path**.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+class SpectraCache:
+    """
+    Memoize the susceptibilities of response files and the spectra of forcings, keyed by (response file hash, nfft)
+    and (forcing short_name, nfft, increment, base_intensity): predicting the responses to many forcings reuses the
+    same transforms. Entries are kept in an in-memory LRU of **maxsize** entries and, if **path** is given, also
+    saved there as .npz files, so that later sessions find them.
+    """
+
+    def __init__(
+            self,
+            maxsize: int = 128,
+            path: str = None,
+    ):
+        """
+        :param maxsize: maximum number of entries in memory
+        :param path: directory where entries are persisted. If None, memory only.
+        """
+        self.maxsize = maxsize
+        self.path = path
+        self._entries = collections.OrderedDict()
+        # file hashes, keyed by (path, size, modification time)
+        self._hashes = {}
+
+        if self.path is not None and not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def _file_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in self._hashes:
+            self._hashes[key] = file_hash(path)
+
+        return self._hashes[key]
+
+    def _entry_path(self, key: tuple) -> str:
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode()).hexdigest() + '.npz')
+
+    def _get(
+            self,
+            key: tuple,
+            compute: T.Callable,
+    ) -> np.ndarray:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        entry_path = self._entry_path(key) if self.path is not None else None
+        if entry_path is not None and os.path.exists(entry_path):
+            with np.load(entry_path) as data:
+                value = data['value']
+        else:
+            value = compute()
+            if entry_path is not None:
+                # unique temporary file, so that sessions sharing the cache directory never write to the same one
+                fd, tmp_path = tempfile.mkstemp(suffix='.tmp.npz', dir=os.path.dirname(entry_path))
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        np.savez(f, value=value)
+                    os.replace(tmp_path, entry_path)
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+
+        self._entries[key] = value
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+        return value
+
+    def susceptibility(
+            self,
+            response_path: str,
+            nfft: int = None,
+    ) -> np.ndarray:
+        """
+        Susceptibility of the response to unit step forcing stored at **response_path** (see
+        compute_susceptibilities).
+        :param response_path: netcdf of the (time_step x 1) mean response, as written by response_avg.py
+        :param nfft: half length of the extended series. If None, from the length of the response.
+        :return: extended susceptibility, (nfft + 1)
+        """
+        with xr.open_dataarray(response_path) as response:
+            nt = response.shape[0]
+            nfft = fft_length(nt) if nfft is None else nfft
+
+            return self._get(
+                ('chi', self._file_hash(response_path), nfft),
+                lambda: compute_susceptibilities(response.values.reshape(nt, -1)[:, 0], nfft),
+            )
+
+    def forcing_spectrum(
+            self,
+            forcing,
+            nfft: int,
+            increment: float = 0.01,
+            base_intensity: float = 8,
+    ) -> np.ndarray:
+        """
+        Spectrum of **forcing** (see compute_forcing_spectra).
+        :return: spectrum, (nfft + 1)
+        """
+        return self._get(
+            ('forcing', forcing.short_name, nfft, increment, base_intensity),
+            lambda: compute_forcing_spectra([forcing], nfft, increment, base_intensity)[0],
+        )
+
+    def responses(
+            self,
+            response_paths: T.Sequence[str],
+            forcings: list,
+            length: int = None,
+            nfft: int = None,
+            increment: float = 0.01,
+            base_intensity: float = 8,
+    ) -> np.ndarray:
+        """
+        Predict the responses of the observables whose step responses are at **response_paths** to **forcings**
+        (see compute_responses), with cached transforms.
+        :return: responses, (observables x forcings x time)
+        """
+        chi = np.stack([self.susceptibility(path, nfft) for path in response_paths])
+        nfft = chi.shape[-1] - 1
+        spectra = np.stack([
+            self.forcing_spectrum(forcing, nfft, increment, base_intensity) for forcing in forcings
+        ])
+
+        return compute_responses(chi, spectra, length)
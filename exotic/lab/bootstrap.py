@@ -0,0 +1,180 @@
+import typing as T
+
+import numpy as np
+import xarray as xr
+
+from . import analysis
+
+
+class MemberStore:
+    """
+    Compact store of per-member samples (e.g. the response of each member to a unit step forcing), as a
+    (members x ...) float32 array grown by doubling as members are appended. Members can be averaged in blocks to
+    shrink it further, and the store can be saved to / loaded from .npz files.
+    """
+
+    def __init__(self):
+        self._data = None
+        self.members = 0
+
+    @property
+    def data(self) -> np.ndarray:
+        """
+        (members x ...) view of the stored samples.
+        """
+        if self._data is None:
+            return np.empty((0,), dtype=np.float32)
+        return self._data[:self.members]
+
+    def append(
+            self,
+            block: np.ndarray,
+    ):
+        """
+        Append the members of **block** (members x ...).
+        """
+        block = np.asarray(block)
+        if self._data is None:
+            self._data = np.empty((max(len(block), 1),) + block.shape[1:], dtype=np.float32)
+        elif block.shape[1:] != self._data.shape[1:]:
+            raise ValueError('members of shape {}, expected {}'.format(block.shape[1:], self._data.shape[1:]))
+
+        end = self.members + len(block)
+        if end > len(self._data):
+            data = np.empty((max(end, 2 * len(self._data)),) + self._data.shape[1:], dtype=np.float32)
+            data[:self.members] = self._data[:self.members]
+            self._data = data
+
+        self._data[self.members:end] = block
+        self.members = end
+
+    def block_means(
+            self,
+            size: int,
+    ) -> 'MemberStore':
+        """
+        Store of the means of consecutive blocks of **size** members (the last partial block is dropped).
+        """
+        blocks = self.members // size
+        store = MemberStore()
+        store.append(self.data[:blocks * size].reshape((blocks, size) + self.data.shape[1:]).mean(axis=1))
+
+        return store
+
+    def save(self, path: str):
+        np.savez(path, data=self.data)
+
+    @classmethod
+    def load(cls, path: str) -> 'MemberStore':
+        store = cls()
+        with np.load(path) as data:
+            store.append(data['data'])
+
+        return store
+
+
+def bootstrap_counts(
+        members: int,
+        replicates: int,
+        random_state: np.random.RandomState = None,
+) -> np.ndarray:
+    """
+    Draw **replicates** bootstrap resamples of **members** members at once, as a single (replicates x members)
+    index matrix, and count how many times each member is drawn in each replicate.
+    :return: (replicates x members) counts
+    """
+    random_state = np.random.RandomState() if random_state is None else random_state
+    index = random_state.randint(0, members, size=(replicates, members))
+    index += np.arange(replicates)[:, None] * members
+
+    return np.bincount(index.ravel(), minlength=replicates * members).reshape(replicates, members)
+
+
+def bootstrap_means(
+        data: np.ndarray,
+        counts: np.ndarray,
+) -> np.ndarray:
+    """
+    Means of the bootstrap replicates defined by **counts** (see bootstrap_counts), as one matrix product, in
+    float64. Pass float64 data when calling it in a loop, so that the samples are not converted at each call.
+    :param data: (members x ...) samples
+    :param counts: (replicates x members) counts
+    :return: (replicates x ...) means
+    """
+    data = np.asarray(data)
+    flat = data.reshape(data.shape[0], -1).astype(np.float64, copy=False)
+
+    means = counts.astype(np.float64) @ flat
+    means /= data.shape[0]
+
+    return means.reshape((counts.shape[0],) + data.shape[1:])
+
+
+def bootstrap_responses(
+        store: T.Union[MemberStore, np.ndarray],
+        forcings: list,
+        replicates: int = 1000,
+        length: int = None,
+        level: float = 0.95,
+        batch: int = 100,
+        seed: int = None,
+        increment: float = 0.01,
+        base_intensity: float = 8,
+) -> xr.Dataset:
+    """
+    Confidence intervals of the linear response predictions (analysis.compute_responses) to **forcings**, by
+    bootstrap over the members of the step responses in **store**. Each replicate mean step response goes through
+    the batched FFT prediction, **batch** replicates per call.
+    :param store: MemberStore or (members x time_step [x node]) array of per-member responses to unit step
+    forcing (e.g. ResponseEstimator(keep_members=True).member_stores)
+    :param forcings: Forcing instances (from lab.simulation.forcings)
+    :param replicates: number of bootstrap replicates
+    :param length: number of predicted time steps. If None, the length of the step responses.
+    :param level: confidence level of the intervals
+    :param batch: number of replicates per FFT call (bounds the temporary memory)
+    :param seed: seed of the resampling
+    :param increment: time between samples of the forcing
+    :param base_intensity: unperturbed forcing
+    :return: Dataset with prediction (from the full ensemble), std, lower and upper over (forcing x time_step)
+    """
+    data = store.data if isinstance(store, MemberStore) else np.asarray(store)
+    if data.ndim == 3:
+        # (members x time_step x node) responses: first node, as in the 'one' output
+        data = data[:, :, 0]
+    members, nt = data.shape
+    length = nt if length is None else length
+
+    nfft = analysis.fft_length(nt)
+    spectra = analysis.compute_forcing_spectra(forcings, nfft, increment, base_intensity)
+
+    prediction = analysis.compute_responses(
+        analysis.compute_susceptibilities(data.mean(axis=0, dtype=np.float64)[None]), spectra, length
+    )[0]
+
+    counts = bootstrap_counts(members, replicates, np.random.RandomState(seed))
+    samples = np.empty((replicates, len(forcings), length), dtype=np.float32)
+    # converted once for all the batches
+    data = data.astype(np.float64, copy=False)
+    for start in range(0, replicates, batch):
+        means = bootstrap_means(data, counts[start:start + batch])
+        samples[start:start + batch] = analysis.compute_responses(
+            analysis.compute_susceptibilities(means), spectra, length
+        )
+
+    lower, upper = np.percentile(samples, [50 * (1 - level), 50 * (1 + level)], axis=0)
+
+    dims = ('forcing', 'time_step')
+    dataset = xr.Dataset(
+        {
+            'prediction': (dims, prediction),
+            'std': (dims, samples.std(axis=0, dtype=np.float64)),
+            'lower': (dims, lower),
+            'upper': (dims, upper),
+        },
+        coords={'forcing': [forcing.short_name for forcing in forcings], 'time_step': np.arange(length)},
+    )
+    dataset.attrs['replicates'] = replicates
+    dataset.attrs['members'] = members
+    dataset.attrs['confidence_level'] = level
+
+    return dataset
@@ -0,0 +1,192 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import typing as T
+
+import numpy as np
+import netCDF4 as nc
+
+from . import response
+
+
+def _read_group(paths: T.Sequence[str]) -> np.ndarray:
+    """
+    Read the (time_step x node) variables of **paths** into one (realization x time_step x node) array.
+    """
+    return np.stack([response.read_var(path) for path in paths])
+
+
+class RealizationMerger:
+    """
+    Merge the outputs of many members into a single netcdf with a leading realization dimension. The merged file is
+    created once, with its full size, and filled group by group with region writes: a pool of worker processes
+    reads groups of **group_size** member files, while this process is the single writer. At most
+    2 * **workers** groups are in flight, so memory is bounded whatever the number of members. Chunks are aligned
+    with the groups (realization chunk = group_size), so each chunk is compressed once, with light zlib by default.
+    The groups written are recorded in a JSON manifest, from which an interrupted merge resumes.
+    """
+
+    def __init__(
+            self,
+            paths: T.Sequence[str],
+            out_path: str,
+            group_size: int = 100,
+            workers: int = None,
+            complevel: int = 1,
+            shuffle: bool = True,
+            chunk_time: int = 1000,
+            manifest_path: str = None,
+    ):
+        """
+        :param paths: member files, in realization order
+        :param out_path: merged netcdf
+        :param group_size: number of members read by a worker at once
+        :param workers: number of reader processes. If None, one per core.
+        :param complevel: zlib compression level of the merged file (0 for none)
+        :param shuffle: if True, apply the HDF5 shuffle filter (with compression)
+        :param chunk_time: time steps per chunk
+        :param manifest_path: manifest of the merge. If None, next to **out_path**.
+        """
+        self.paths = list(paths)
+        self.out_path = out_path
+        self.group_size = group_size
+        self.workers = workers or os.cpu_count() or 1
+        self.complevel = complevel
+        self.shuffle = shuffle
+        self.chunk_time = chunk_time
+        self.manifest_path = manifest_path if manifest_path is not None else out_path + '.manifest.json'
+
+    @property
+    def groups(self) -> T.List[T.Tuple[int, int]]:
+        """
+        (start, end) realization indices of each group.
+        """
+        return [
+            (start, min(start + self.group_size, len(self.paths)))
+            for start in range(0, len(self.paths), self.group_size)
+        ]
+
+    def _fingerprint(self) -> str:
+        digest = hashlib.sha1()
+        for path in self.paths:
+            digest.update(os.path.abspath(path).encode())
+            digest.update(b'\0')
+        digest.update(str(self.group_size).encode())
+
+        return digest.hexdigest()
+
+    def _load_manifest(self) -> T.Union[dict, None]:
+        if not (os.path.exists(self.manifest_path) and os.path.exists(self.out_path)):
+            return None
+
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+
+        if manifest.get('fingerprint') != self._fingerprint() or manifest.get('out_path') != self.out_path:
+            return None
+
+        return manifest
+
+    def _save_manifest(self, manifest: dict):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _create(self) -> nc.Dataset:
+        """
+        Create the merged file, taking shape, time steps and attributes from the first member.
+        """
+        with nc.Dataset(self.paths[0]) as first:
+            var_first = first.variables['var']
+            time_steps, nodes = var_first.shape
+            attrs = {key: var_first.getncattr(key) for key in var_first.ncattrs() if key != '_FillValue'}
+            time_step = first.variables['time_step']
+            time_step.set_auto_mask(False)
+            time_step = np.asarray(time_step[:])
+
+        dataset = nc.Dataset(self.out_path, 'w')
+        dataset.createDimension('realization', len(self.paths))
+        dataset.createDimension('time_step', time_steps)
+        dataset.createDimension('node', nodes)
+
+        dataset.createVariable('realization', np.int32, ('realization',))[:] = np.arange(len(self.paths))
+        dataset.createVariable('time_step', time_step.dtype, ('time_step',))[:] = time_step
+        dataset.createVariable('node', np.int32, ('node',))[:] = np.arange(nodes)
+
+        var = dataset.createVariable(
+            'var',
+            np.float32,
+            ('realization', 'time_step', 'node'),
+            zlib=self.complevel > 0,
+            complevel=max(self.complevel, 1),
+            shuffle=self.shuffle and self.complevel > 0,
+            chunksizes=(min(self.group_size, len(self.paths)), min(self.chunk_time, time_steps), nodes),
+        )
+        var.setncatts(attrs)
+
+        return dataset
+
+    def run(
+            self,
+            callback: T.Callable = None,
+    ) -> str:
+        """
+        Merge the members, resuming from the manifest if it matches this merge.
+        :param callback: if given, called as callback(groups done, groups) after each group is written
+        :return: path of the merged file
+        """
+        groups = self.groups
+        manifest = self._load_manifest()
+
+        if manifest is None:
+            dataset = self._create()
+            manifest = {'fingerprint': self._fingerprint(), 'out_path': self.out_path, 'done': []}
+            self._save_manifest(manifest)
+        else:
+            dataset = nc.Dataset(self.out_path, 'a')
+
+        done = set(manifest['done'])
+        to_do = [group for group in range(len(groups)) if group not in done]
+        var = dataset.variables['var']
+
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+                pending = {}
+                queue = iter(to_do)
+
+                def submit():
+                    group = next(queue, None)
+                    if group is not None:
+                        start, end = groups[group]
+                        pending[executor.submit(_read_group, self.paths[start:end])] = group
+
+                for _ in range(2 * self.workers):
+                    submit()
+
+                while pending:
+                    finished, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        group = pending.pop(future)
+                        data = future.result()
+                        start, end = groups[group]
+                        if data.shape[1:] != var.shape[1:]:
+                            raise ValueError('members {}-{} have shape {}, expected {}'.format(
+                                start, end - 1, data.shape[1:], var.shape[1:]
+                            ))
+                        var[start:end] = data
+                        dataset.sync()
+
+                        manifest['done'].append(group)
+                        self._save_manifest(manifest)
+                        submit()
+
+                        if callback is not None:
+                            callback(len(manifest['done']), len(groups))
+        finally:
+            dataset.close()
+
+        os.remove(self.manifest_path)
+
+        return self.out_path
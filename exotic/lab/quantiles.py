@@ -0,0 +1,504 @@
+import os
+import tempfile
+import typing as T
+
+import numpy as np
+import xarray as xr
+
+
+class HistogramSketch:
+    """
+    Streaming quantile estimator based on a fixed-bin, high-resolution histogram over [**lower**, **upper**).
+    Values are added in batches (e.g. file by file) and any set of quantile orders is answered from the cumulative
+    counts, with memory independent of the number of values. Within the range the error of a quantile is at most one
+    bin width; values outside the range are only counted (quantiles falling among them are clipped to the exact
+    minimum or maximum seen). Sketches with the same bins can be merged, and saved to / loaded from .npz files, so
+    that separate runs can be combined.
+    """
+
+    def __init__(
+            self,
+            lower: float,
+            upper: float,
+            bins: int = 2 ** 20,
+    ):
+        """
+        :param lower: lower edge of the first bin
+        :param upper: upper edge of the last bin
+        :param bins: number of bins
+        """
+        if not upper > lower:
+            raise ValueError('upper ({}) must be greater than lower ({})'.format(upper, lower))
+
+        self.lower = float(lower)
+        self.upper = float(upper)
+        self.bins = int(bins)
+        # counts[0]: values below lower, counts[-1]: values not below upper
+        self.counts = np.zeros(self.bins + 2, dtype=np.int64)
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    @property
+    def bin_width(self) -> float:
+        return (self.upper - self.lower) / self.bins
+
+    def update(
+            self,
+            values: np.ndarray,
+    ):
+        """
+        Add **values** (any shape; NaNs are ignored).
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+
+        index = np.floor((values - self.lower) / self.bin_width)
+        np.clip(index + 1, 0, self.bins + 1, out=index)
+        self.counts += np.bincount(index.astype(np.int64), minlength=self.bins + 2)
+
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    def merge(
+            self,
+            other: 'HistogramSketch',
+    ):
+        """
+        Add the values counted by **other**, which must have the same bins.
+        """
+        if (other.lower, other.upper, other.bins) != (self.lower, self.upper, self.bins):
+            raise ValueError('cannot merge sketches with different bins: {} and {}'.format(
+                (self.lower, self.upper, self.bins), (other.lower, other.upper, other.bins)
+            ))
+        self.counts += other.counts
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(
+            self,
+            q: T.Union[float, T.Sequence[float]],
+    ) -> np.ndarray:
+        """
+        Estimate the quantiles of orders **q**, all at once. As np.quantile (linear method), the quantile of order q
+        is the value of rank q * (count - 1) among the sorted values; values are assumed uniform within each bin.
+        :param q: quantile order or sequence of orders, in [0, 1]
+        :return: quantiles (same shape as **q**)
+        """
+        count = self.count
+        if count == 0:
+            raise ValueError('no values in the sketch')
+
+        q = np.asarray(q, dtype=np.float64)
+        rank = q * (count - 1)
+
+        cumulative = np.cumsum(self.counts)
+        index = np.searchsorted(cumulative, rank, side='right')
+        index = np.minimum(index, self.bins + 1)
+        before = np.where(index > 0, cumulative[np.maximum(index - 1, 0)], 0)
+
+        # bin i (1..bins) covers [lower + (i - 1) * width, lower + i * width)
+        fraction = (rank - before + 0.5) / np.maximum(self.counts[index], 1)
+        values = self.lower + (index - 1 + fraction) * self.bin_width
+        values = np.where(index == 0, self.min, values)
+        values = np.where(index == self.bins + 1, self.max, values)
+
+        return np.clip(values, self.min, self.max)
+
+    def state(self) -> dict:
+        """
+        State of the sketch, as a dict of arrays (see from_state).
+        """
+        return {
+            'lower': np.float64(self.lower),
+            'upper': np.float64(self.upper),
+            'bins': np.int64(self.bins),
+            'counts': self.counts,
+            'min': np.float64(self.min),
+            'max': np.float64(self.max),
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'HistogramSketch':
+        """
+        Rebuild a sketch from its state().
+        """
+        sketch = cls(float(state['lower']), float(state['upper']), int(state['bins']))
+        sketch.counts = np.asarray(state['counts'], dtype=np.int64).copy()
+        sketch.min = float(state['min'])
+        sketch.max = float(state['max'])
+
+        return sketch
+
+    def save(self, path: str):
+        """
+        Save the sketch to the .npz file at **path**.
+        """
+        np.savez(path, **self.state())
+
+    @classmethod
+    def load(cls, path: str) -> 'HistogramSketch':
+        """
+        Load a sketch saved with save().
+        """
+        with np.load(path) as data:
+            return cls.from_state({key: data[key] for key in data.files})
+
+
+class ExactQuantiles:
+    """
+    Exact quantiles of values added in batches. Values are copied into a preallocated float32 buffer (grown by
+    doubling if it fills up), and any set of quantile orders is answered by a single np.quantile call with the vector
+    of orders, i.e. one partition of the data for the whole set. Same interface as HistogramSketch (update, quantile,
+    count), but memory grows with the number of values.
+    """
+
+    def __init__(
+            self,
+            size: int = 0,
+    ):
+        """
+        :param size: expected number of values (initial size of the buffer)
+        """
+        self.buffer = np.empty(size, dtype=np.float32)
+        self._count = 0
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def update(
+            self,
+            values: np.ndarray,
+    ):
+        """
+        Add **values** (any shape; NaNs are ignored).
+        """
+        values = np.asarray(values).ravel()
+        values = values[~np.isnan(values)]
+
+        end = self._count + len(values)
+        if end > len(self.buffer):
+            buffer = np.empty(max(end, 2 * len(self.buffer)), dtype=np.float32)
+            buffer[:self._count] = self.buffer[:self._count]
+            self.buffer = buffer
+
+        self.buffer[self._count:end] = values
+        self._count = end
+
+    def quantile(
+            self,
+            q: T.Union[float, T.Sequence[float]],
+            overwrite_input: bool = True,
+    ) -> np.ndarray:
+        """
+        Compute the quantiles of orders **q**, all at once (np.quantile, linear method).
+        :param q: quantile order or sequence of orders, in [0, 1]
+        :param overwrite_input: if True, partition the buffer in place instead of a copy of it. Only the order of the
+        stored values changes, so later calls are still exact.
+        :return: quantiles (same shape as **q**)
+        """
+        if self._count == 0:
+            raise ValueError('no values added')
+
+        return np.quantile(self.buffer[:self._count], q, overwrite_input=overwrite_input)
+
+
+class QuantileTable:
+    """
+    Store of quantiles, mapping (observable, forcing, quantile_order) to value. Next to the values of each
+    (observable, forcing) pair it keeps the HistogramSketch they were computed from and the members counted in it,
+    so that new members are merged into the sketch and new orders are answered from it, without going back to the
+    raw data. Quantiles stored from elsewhere (e.g. computed exactly) are kept with the members they were computed
+    over, and a pair holds either sketched or such quantiles, never both, so that neither silently replaces the
+    other. Each pair is saved as a .npz file in the directory **path**, rewritten atomically at each change.
+    """
+
+    # tolerance when matching quantile orders (orders built with np.arange carry rounding errors)
+    order_tolerance = 1e-6
+
+    def __init__(
+            self,
+            path: str,
+    ):
+        """
+        :param path: directory of the table (created if missing)
+        """
+        self.path = path
+        self._entries = {}
+
+    def _entry_path(
+            self,
+            observable: str,
+            forcing: str,
+    ) -> str:
+        return os.path.join(self.path, forcing, 'quantiles_{}.npz'.format(observable))
+
+    def _entry(
+            self,
+            observable: str,
+            forcing: str,
+    ) -> dict:
+        key = (observable, forcing)
+        if key not in self._entries:
+            path = self._entry_path(observable, forcing)
+            if os.path.exists(path):
+                with np.load(path) as data:
+                    entry = {key: data[key] for key in data.files}
+            else:
+                entry = {
+                    'orders': np.empty(0),
+                    'values': np.empty(0),
+                    'members': np.empty(0, dtype=np.int64),
+                }
+            self._entries[key] = entry
+
+        return self._entries[key]
+
+    def _save(
+            self,
+            observable: str,
+            forcing: str,
+    ):
+        path = self._entry_path(observable, forcing)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # unique temporary file, so that processes sharing the table never write to the same one
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp.npz', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **self._entry(observable, forcing))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def has(
+            self,
+            observable: str,
+            forcing: str,
+    ) -> bool:
+        return len(self._entry(observable, forcing)['orders']) > 0 or self.sketch(observable, forcing) is not None
+
+    def source(
+            self,
+            observable: str,
+            forcing: str,
+    ) -> T.Union[str, None]:
+        """
+        Where the quantiles of (**observable**, **forcing**) come from: 'sketch' (add_members), 'values'
+        (set_values, e.g. exact quantiles) or None if nothing is stored.
+        """
+        entry = self._entry(observable, forcing)
+        if 'source' in entry:
+            return str(entry['source'])
+        # entries saved before the source was recorded
+        if 'counts' in entry:
+            return 'sketch'
+        if len(entry['orders']):
+            return 'values'
+        return None
+
+    def sketch(
+            self,
+            observable: str,
+            forcing: str,
+    ) -> T.Union[HistogramSketch, None]:
+        """
+        Sketch of (**observable**, **forcing**), or None if its quantiles did not come from a sketch.
+        """
+        entry = self._entry(observable, forcing)
+        if 'counts' not in entry:
+            return None
+        return HistogramSketch.from_state(entry)
+
+    def members(
+            self,
+            observable: str,
+            forcing: str,
+    ) -> np.ndarray:
+        """
+        Members counted in the sketch of (**observable**, **forcing**), or over which its stored values were
+        computed (see set_values).
+        """
+        return self._entry(observable, forcing)['members']
+
+    def orders(
+            self,
+            observable: str,
+            forcing: str,
+    ) -> np.ndarray:
+        return self._entry(observable, forcing)['orders']
+
+    def _find(
+            self,
+            entry: dict,
+            quantile_order: float,
+    ) -> int:
+        found = np.flatnonzero(np.abs(entry['orders'] - quantile_order) <= self.order_tolerance)
+        return found[0] if len(found) else -1
+
+    def _set(
+            self,
+            entry: dict,
+            orders: np.ndarray,
+            values: np.ndarray,
+    ):
+        for order, value in zip(orders, values):
+            i = self._find(entry, order)
+            if i >= 0:
+                entry['values'][i] = value
+            else:
+                entry['orders'] = np.append(entry['orders'], order)
+                entry['values'] = np.append(entry['values'], value)
+        sort = np.argsort(entry['orders'])
+        entry['orders'] = entry['orders'][sort]
+        entry['values'] = entry['values'][sort]
+
+    def add_members(
+            self,
+            observable: str,
+            forcing: str,
+            sketch: HistogramSketch,
+            members: T.Iterable[int],
+    ):
+        """
+        Merge **sketch**, computed over **members**, into the sketch of (**observable**, **forcing**), and recompute
+        the stored quantiles from the merged sketch.
+        :raise ValueError: if some of the members were already added, or if the quantiles of the pair were not
+        computed from a sketch
+        """
+        entry = self._entry(observable, forcing)
+        members = np.asarray(list(members), dtype=np.int64)
+
+        if self.source(observable, forcing) == 'values':
+            raise ValueError('{} ({}) holds quantiles not computed from a sketch, remove {} first'.format(
+                observable, forcing, self._entry_path(observable, forcing)
+            ))
+
+        duplicated = np.intersect1d(entry['members'], members)
+        if len(duplicated):
+            raise ValueError('members {} of {} ({}) already in the table'.format(
+                duplicated.tolist(), observable, forcing
+            ))
+
+        merged = self.sketch(observable, forcing)
+        if merged is None:
+            merged = HistogramSketch.from_state(sketch.state())
+        else:
+            merged.merge(sketch)
+
+        entry.update(merged.state())
+        entry['source'] = np.array('sketch')
+        entry['members'] = np.union1d(entry['members'], members)
+        if len(entry['orders']):
+            entry['values'] = np.asarray(merged.quantile(entry['orders']), dtype=np.float64)
+
+        self._save(observable, forcing)
+
+    def add_orders(
+            self,
+            observable: str,
+            forcing: str,
+            orders: T.Sequence[float],
+    ) -> np.ndarray:
+        """
+        Compute the quantiles of **orders** from the sketch of (**observable**, **forcing**) and store them.
+        :return: quantiles
+        """
+        sketch = self.sketch(observable, forcing)
+        if sketch is None:
+            raise KeyError('no sketch for {} ({})'.format(observable, forcing))
+
+        orders = np.asarray(orders, dtype=np.float64)
+        values = sketch.quantile(orders)
+        self._set(self._entry(observable, forcing), orders, values)
+        self._save(observable, forcing)
+
+        return values
+
+    def set_values(
+            self,
+            observable: str,
+            forcing: str,
+            orders: T.Sequence[float],
+            values: T.Sequence[float],
+            members: T.Iterable[int] = (),
+    ):
+        """
+        Store quantiles computed elsewhere (e.g. exactly, with ExactQuantiles), over **members**. Values of other
+        orders can be added later, computed over the same members.
+        :param members: members the quantiles were computed over (empty if unknown)
+        :raise ValueError: if the pair holds sketched quantiles, or values computed over other members
+        """
+        entry = self._entry(observable, forcing)
+        members = np.unique(np.asarray(list(members), dtype=np.int64))
+
+        source = self.source(observable, forcing)
+        if source == 'sketch':
+            raise ValueError('{} ({}) holds quantiles computed from a sketch, remove {} first'.format(
+                observable, forcing, self._entry_path(observable, forcing)
+            ))
+        if source == 'values' and not np.array_equal(entry['members'], members):
+            raise ValueError('{} ({}) holds quantiles computed over other members'.format(observable, forcing))
+
+        self._set(entry, np.asarray(orders, dtype=np.float64), np.asarray(values, dtype=np.float64))
+        entry['source'] = np.array('values')
+        entry['members'] = members
+        self._save(observable, forcing)
+
+    def value(
+            self,
+            observable: str,
+            forcing: str,
+            quantile_order: float,
+    ) -> float:
+        """
+        Quantile of order **quantile_order** of (**observable**, **forcing**). Orders not stored yet are computed from
+        the sketch, in memory: lookups never write to the table, so many processes can read it at once (use
+        add_orders to store them).
+        :raise KeyError: if the order is not stored and there is no sketch
+        """
+        entry = self._entry(observable, forcing)
+        i = self._find(entry, quantile_order)
+        if i >= 0:
+            return float(entry['values'][i])
+
+        sketch = self.sketch(observable, forcing)
+        if sketch is None:
+            raise KeyError('no quantile of order {} and no sketch for {} ({})'.format(
+                quantile_order, observable, forcing
+            ))
+        return float(sketch.quantile(quantile_order))
+
+    def import_dataarray(
+            self,
+            observable: str,
+            forcing: str,
+            quantiles: xr.DataArray,
+    ):
+        """
+        Store the quantiles of a DataArray over quantile_order, as written by the old compute_quantile.py.
+        """
+        self.set_values(observable, forcing, quantiles.quantile_order.values, quantiles.values)
+
+    def to_dataarray(
+            self,
+            observable: str,
+            forcing: str,
+    ) -> xr.DataArray:
+        """
+        Quantiles of (**observable**, **forcing**) as a DataArray over quantile_order (format of the old
+        compute_quantile.py).
+        """
+        entry = self._entry(observable, forcing)
+        quantiles = xr.DataArray(entry['values'], coords=[entry['orders']], dims=['quantile_order'])
+        sketch = self.sketch(observable, forcing)
+        if sketch is not None:
+            quantiles.attrs['total_timesteps'] = sketch.count
+
+        return quantiles
@@ -0,0 +1,321 @@
+import typing as T
+
+import numpy as np
+import netCDF4 as nc
+import xarray as xr
+from scipy import stats
+
+from . import bootstrap
+from .simulation import observables
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+def read_var(path: str) -> np.ndarray:
+    """
+    Read the whole (time_step x node) variable of a simulation output as a plain float32 array, without xarray.
+    Missing values are returned as NaN.
+    :param path: netcdf file or (if the path ends with .zarr) Zarr store written by SimulationRunner
+    :return: array
+    """
+    if path.endswith('.zarr'):
+        if zarr is None:
+            raise ImportError('zarr is not installed')
+        return np.asarray(zarr.open_group(path, mode='r')['var'][:], dtype=np.float32)
+
+    with nc.Dataset(path) as dataset:
+        var = dataset.variables['var']
+        var.set_auto_mask(False)
+        data = np.asarray(var[:], dtype=np.float32)
+        fill_value = getattr(var, '_FillValue', nc.default_fillvals['f4'])
+        data[data == fill_value] = np.nan
+
+    return data
+
+
+def read_time_steps(path: str) -> np.ndarray:
+    """
+    Read the time steps of a simulation output (see read_var).
+    """
+    if path.endswith('.zarr'):
+        if zarr is None:
+            raise ImportError('zarr is not installed')
+        return np.asarray(zarr.open_group(path, mode='r')['time_step'][:])
+
+    with nc.Dataset(path) as dataset:
+        time_step = dataset.variables['time_step']
+        time_step.set_auto_mask(False)
+        return np.asarray(time_step[:])
+
+
+class RunningStats:
+    """
+    Streaming mean and variance along the first axis of blocks of samples, kept per element of the remaining axes.
+    Blocks are merged with the parallel form of Welford's algorithm (Chan et al.), which is numerically stable and
+    needs memory proportional to a single sample. NaN samples are skipped, so that counts can differ between
+    elements.
+    """
+
+    def __init__(
+            self,
+            shape: T.Tuple[int, ...] = None,
+    ):
+        """
+        :param shape: shape of a sample. If given, the statistics are preallocated, and blocks can update part of
+        them (see update); otherwise the shape is taken from the first block.
+        """
+        if shape is None:
+            self.count = None
+            self._mean = None
+            self._m2 = None
+        else:
+            self.count = np.zeros(shape, dtype=np.int64)
+            self._mean = np.zeros(shape)
+            self._m2 = np.zeros(shape)
+
+    def update(
+            self,
+            block: np.ndarray,
+            index=Ellipsis,
+    ):
+        """
+        Add the samples in **block** (samples x ...).
+        :param block: samples
+        :param index: index (e.g. a slice of time steps) of the part of the statistics that the samples cover
+        """
+        block = np.asarray(block, dtype=np.float64)
+        valid = ~np.isnan(block)
+
+        count_b = valid.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_b = np.where(count_b > 0, np.nansum(block, axis=0) / count_b, 0.)
+        m2_b = np.nansum(np.square(block - mean_b), axis=0)
+
+        if self.count is None:
+            if index is not Ellipsis:
+                raise ValueError('partial updates need the shape of a sample')
+            self.count, self._mean, self._m2 = count_b, mean_b, m2_b
+            return
+
+        count_a = self.count[index]
+        count = count_a + count_b
+        delta = mean_b - self._mean[index]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight_b = np.where(count > 0, count_b / count, 0.)
+        self._mean[index] = self._mean[index] + delta * weight_b
+        self._m2[index] = self._m2[index] + m2_b + np.square(delta) * count_a * weight_b
+        self.count[index] = count
+
+    def merge(
+            self,
+            other: 'RunningStats',
+    ):
+        """
+        Add the samples accumulated by **other** (e.g. by another process).
+        """
+        if other.count is None:
+            return
+        if self.count is None:
+            self.count, self._mean, self._m2 = other.count.copy(), other._mean.copy(), other._m2.copy()
+            return
+
+        count = self.count + other.count
+        delta = other._mean - self._mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight_other = np.where(count > 0, other.count / count, 0.)
+        self._mean = self._mean + delta * weight_other
+        self._m2 = self._m2 + other._m2 + np.square(delta) * self.count * weight_other
+        self.count = count
+
+    @property
+    def mean(self) -> np.ndarray:
+        return np.where(self.count > 0, self._mean, np.nan)
+
+    @property
+    def variance(self) -> np.ndarray:
+        """
+        Unbiased sample variance (NaN where fewer than two samples).
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, self._m2 / (self.count - 1), np.nan)
+
+    @property
+    def std_error(self) -> np.ndarray:
+        """
+        Standard error of the mean.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(self.variance / self.count)
+
+    def confidence_band(
+            self,
+            level: float = 0.95,
+    ) -> T.Tuple[np.ndarray, np.ndarray]:
+        """
+        Normal confidence band of the mean.
+        :param level: confidence level
+        :return: lower and upper bounds
+        """
+        half_width = stats.norm.ppf(0.5 + level / 2) * self.std_error
+        return self.mean - half_width, self.mean + half_width
+
+
+def stats_dataset(
+        running_stats: RunningStats,
+        time_steps: np.ndarray,
+        short_name: str,
+        level: float = 0.95,
+) -> xr.Dataset:
+    """
+    Dataset of the (time_step x node) statistics **running_stats** of observable **short_name**, as variables mean,
+    variance, count, std_error, lower and upper (bounds of the confidence band of the mean at **level**).
+    """
+    lower, upper = running_stats.confidence_band(level)
+    coords = {'time_step': time_steps, 'node': np.arange(running_stats.mean.shape[-1])}
+    dims = ('time_step', 'node')
+
+    dataset = xr.Dataset(
+        {
+            'mean': (dims, running_stats.mean),
+            'variance': (dims, running_stats.variance),
+            'count': (dims, running_stats.count),
+            'std_error': (dims, running_stats.std_error),
+            'lower': (dims, lower),
+            'upper': (dims, upper),
+        },
+        coords=coords,
+    )
+    dataset.attrs['observable'] = short_name
+    dataset.attrs['confidence_level'] = level
+
+    return dataset
+
+
+class ResponseEstimator:
+    """
+    Estimate the ensemble mean response of an observable, i.e. the mean over members of
+    observable(forced run) - observable(unforced run), with its variance and confidence band. Members are read in
+    blocks of **block_members** pairs of files into a preallocated buffer, the observable is computed on plain NumPy
+    arrays, and the blocks are accumulated with RunningStats: memory does not grow with the number of members.
+    Given an ObservableSet, the responses of all its observables are accumulated separately over the same reads.
+    """
+
+    def __init__(
+            self,
+            observable,
+            block_members: int = 256,
+            level: float = 0.95,
+            keep_members: bool = False,
+    ):
+        """
+        :param observable: observable or ObservableSet (from lab.simulation.observables), applied to
+        (members x time_step x node) arrays
+        :param block_members: number of members read at once
+        :param level: confidence level of the bands
+        :param keep_members: if True, also keep the response of each member in **member_stores** (float32
+        bootstrap.MemberStore per observable), e.g. for bootstrap.bootstrap_responses
+        """
+        self.observable = observable
+        if isinstance(observable, observables.ObservableSet):
+            self.observables = observable
+        else:
+            self.observables = observables.ObservableSet([observable])
+        self.block_members = block_members
+        self.level = level
+        self.stats_set = {short_name: RunningStats() for short_name in self.observables.short_names}
+        self.member_stores = None
+        if keep_members:
+            self.member_stores = {short_name: bootstrap.MemberStore() for short_name in self.observables.short_names}
+        self.time_steps = None
+
+    def _read_block(
+            self,
+            paths: T.Sequence[str],
+            buffer: np.ndarray,
+            first: np.ndarray = None,
+    ) -> np.ndarray:
+        """
+        Read **paths** into **buffer**. If given, **first** is the data of the first path, already read.
+        """
+        for i, path in enumerate(paths):
+            data = read_var(path) if i > 0 or first is None else first
+            if data.shape != buffer.shape[1:]:
+                raise ValueError('{} has shape {}, expected {}'.format(path, data.shape, buffer.shape[1:]))
+            buffer[i] = data
+        return buffer[:len(paths)]
+
+    def update(
+            self,
+            forced_paths: T.Sequence[str],
+            unforced_paths: T.Sequence[str],
+            callback: T.Callable = None,
+    ):
+        """
+        Add the members whose forced and unforced runs are in **forced_paths** and **unforced_paths**.
+        :param forced_paths: outputs of the forced runs
+        :param unforced_paths: outputs of the unforced runs, in the same order
+        :param callback: if given, called as callback(members done, members) after each block
+        :return: None
+        """
+        if len(forced_paths) != len(unforced_paths):
+            raise ValueError('{} forced and {} unforced runs given'.format(len(forced_paths), len(unforced_paths)))
+        if not forced_paths:
+            return
+
+        if self.time_steps is None:
+            self.time_steps = read_time_steps(forced_paths[0])
+        # the shape of the buffers is that of the first member, which is then not read again
+        first = read_var(forced_paths[0])
+
+        block_members = min(self.block_members, len(forced_paths))
+        forced = np.empty((block_members,) + first.shape, dtype=np.float32)
+        unforced = np.empty((block_members,) + first.shape, dtype=np.float32)
+
+        for start in range(0, len(forced_paths), block_members):
+            end = start + block_members
+            obs_forced = self.observables.compute(
+                self._read_block(forced_paths[start:end], forced, first if start == 0 else None)
+            )
+            obs_unforced = self.observables.compute(self._read_block(unforced_paths[start:end], unforced))
+            for short_name, running_stats in self.stats_set.items():
+                response = np.asarray(obs_forced[short_name], dtype=np.float64)
+                response -= obs_unforced[short_name]
+                running_stats.update(response)
+                if self.member_stores is not None:
+                    self.member_stores[short_name].append(response)
+
+            if callback is not None:
+                callback(min(end, len(forced_paths)), len(forced_paths))
+
+    @property
+    def stats(self) -> RunningStats:
+        """
+        Statistics of the response of the (first) observable.
+        """
+        return self.stats_set[self.observables.short_names[0]]
+
+    def to_dataset(
+            self,
+            short_name: str = None,
+    ) -> xr.Dataset:
+        """
+        Ensemble statistics of the response, as variables mean, variance, count, std_error, lower and upper
+        (bounds of the confidence band) over (time_step x node).
+        :param short_name: observable (with an ObservableSet). If None, the first one.
+        """
+        if short_name is None:
+            short_name = self.observables.short_names[0]
+        running_stats = self.stats_set[short_name]
+
+        time_steps = self.time_steps if self.time_steps is not None else np.arange(len(running_stats.mean))
+
+        return stats_dataset(running_stats, time_steps, short_name, self.level)
+
+    def to_datasets(self) -> T.Dict[str, xr.Dataset]:
+        """
+        Statistics of the responses of all observables (see to_dataset), keyed by short name.
+        """
+        return {short_name: self.to_dataset(short_name) for short_name in self.observables.short_names}
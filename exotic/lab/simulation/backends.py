@@ -0,0 +1,315 @@
+import os
+
+import numpy as np
+import netCDF4 as nc
+
+try:
+    import zarr
+    from numcodecs import Blosc
+except ImportError:
+    zarr = None
+
+
+class NetCDFOutput:
+    """
+    Output written by SimulationRunner into a netcdf file.
+    """
+
+    def __init__(self, dataset: nc.Dataset):
+        self.dataset = dataset
+
+    def write(
+            self,
+            start: int,
+            time_steps: np.ndarray,
+            data: np.ndarray,
+    ):
+        """
+        Write **data** (records x nodes) and their **time_steps** from record **start** on.
+        """
+        end = start + len(data)
+        self.dataset.variables['var'][start:end, :] = data
+        self.dataset.variables['time_step'][start:end] = time_steps
+
+    def sync(self):
+        self.dataset.sync()
+
+    def close(self):
+        self.dataset.close()
+
+
+class NetCDFBackend:
+    """
+    Write SimulationRunner output as NETCDF4_CLASSIC files. By default the time_step dimension is unlimited and the
+    netcdf library picks chunking, without compression; all of these can be set explicitly. The chosen layout is
+    recorded in the attributes of the variable.
+    """
+
+    def __init__(
+            self,
+            chunk_time: int = None,
+            chunk_nodes: int = None,
+            zlib: bool = False,
+            complevel: int = 4,
+            shuffle: bool = True,
+            fixed_length: bool = False,
+    ):
+        """
+        :param chunk_time: records per chunk. If None, library default chunking.
+        :param chunk_nodes: nodes per chunk (with chunk_time). If None, all nodes in one chunk.
+        :param zlib: if True, compress with zlib
+        :param complevel: zlib compression level
+        :param shuffle: if True, apply the HDF5 shuffle filter (with zlib)
+        :param fixed_length: if True, the time_step dimension has the length of the whole simulation (computed
+        from integration_time and write_*_every), instead of being unlimited
+        """
+        self.chunk_time = chunk_time
+        self.chunk_nodes = chunk_nodes
+        self.zlib = zlib
+        self.complevel = complevel
+        self.shuffle = shuffle
+        self.fixed_length = fixed_length
+
+    @property
+    def short_name(self):
+        return 'netcdf'
+
+    @property
+    def extension(self):
+        return '.nc'
+
+    def _chunksizes(
+            self,
+            nodes: int,
+            records: int,
+    ):
+        if self.chunk_time is None:
+            return None
+        chunk_time = min(self.chunk_time, records) if self.fixed_length else self.chunk_time
+        return max(chunk_time, 1), min(self.chunk_nodes or nodes, nodes)
+
+    def create(
+            self,
+            path: str,
+            nodes: int,
+            records: int,
+            attrs: dict,
+    ) -> NetCDFOutput:
+        """
+        Create (or overwrite) the output at **path**.
+        :param path: path of the output
+        :param nodes: number of recorded nodes
+        :param records: number of time steps that will be written
+        :param attrs: attributes of the variable
+        :return: output
+        """
+        dataset = nc.Dataset(path, 'w', format='NETCDF4_CLASSIC')
+
+        dataset.createDimension('node', nodes)
+        dataset.createDimension('time_step', records if self.fixed_length else None)
+
+        dataset.createVariable('node', np.int32, ('node',))
+        dataset.createVariable('time_step', np.int32, ('time_step',))
+
+        chunksizes = self._chunksizes(nodes, records)
+        var = dataset.createVariable(
+            'var',
+            np.float32,
+            ('time_step', 'node'),
+            zlib=self.zlib,
+            complevel=self.complevel,
+            shuffle=self.shuffle and self.zlib,
+            chunksizes=chunksizes,
+        )
+
+        dataset.variables['node'][:] = np.arange(0, nodes)
+
+        for attr_key, attr_value in attrs.items():
+            var.setncattr(attr_key, attr_value)
+
+        # Layout
+        var.setncattr('time_dimension', 'fixed' if self.fixed_length else 'unlimited')
+        var.setncattr('chunk_sizes', 'default' if chunksizes is None else 'x'.join(str(size) for size in chunksizes))
+        if self.zlib:
+            var.setncattr('compression', 'zlib{}{}'.format(self.complevel, '+shuffle' if self.shuffle else ''))
+        else:
+            var.setncattr('compression', 'none')
+
+        return NetCDFOutput(dataset)
+
+    def open(
+            self,
+            path: str,
+    ) -> NetCDFOutput:
+        """
+        Open the existing output at **path** to append to it.
+        """
+        return NetCDFOutput(nc.Dataset(path, 'a'))
+
+    def records(
+            self,
+            path: str,
+    ) -> int:
+        """
+        Number of time steps written to the output at **path** (0 if missing or unreadable).
+        """
+        try:
+            with nc.Dataset(path) as dataset:
+                time_step = dataset.variables['time_step']
+                if len(time_step) == 0 or np.ma.is_masked(time_step[-1]):
+                    return 0
+                return len(time_step)
+        except (OSError, KeyError):
+            return 0
+
+
+class ZarrOutput:
+    """
+    Output written by SimulationRunner into a Zarr store.
+    """
+
+    def __init__(self, group):
+        self.group = group
+
+    def write(
+            self,
+            start: int,
+            time_steps: np.ndarray,
+            data: np.ndarray,
+    ):
+        """
+        Write **data** (records x nodes) and their **time_steps** from record **start** on.
+        """
+        end = start + len(data)
+        self.group['var'][start:end, :] = data
+        self.group['time_step'][start:end] = time_steps
+        self.group.attrs['records'] = max(end, self.group.attrs.get('records', 0))
+
+    def sync(self):
+        pass
+
+    def close(self):
+        zarr.consolidate_metadata(self.group.store)
+
+
+class ZarrBackend:
+    """
+    Write SimulationRunner output as Zarr stores, readable in parallel by xarray/dask (xr.open_zarr). Arrays have
+    their full length from the start and explicit (time_step x node) chunks, compressed with Blosc.
+    """
+
+    def __init__(
+            self,
+            chunk_time: int = 10000,
+            chunk_nodes: int = None,
+            cname: str = 'lz4',
+            clevel: int = 5,
+            shuffle: bool = True,
+    ):
+        """
+        :param chunk_time: records per chunk
+        :param chunk_nodes: nodes per chunk. If None, all nodes in one chunk.
+        :param cname: Blosc codec
+        :param clevel: Blosc compression level
+        :param shuffle: if True, apply byte shuffle before compression
+        """
+        if zarr is None:
+            raise ImportError('zarr is not installed')
+
+        self.chunk_time = chunk_time
+        self.chunk_nodes = chunk_nodes
+        self.compressor = Blosc(cname=cname, clevel=clevel, shuffle=Blosc.SHUFFLE if shuffle else Blosc.NOSHUFFLE)
+
+    @property
+    def short_name(self):
+        return 'zarr'
+
+    @property
+    def extension(self):
+        return '.zarr'
+
+    def create(
+            self,
+            path: str,
+            nodes: int,
+            records: int,
+            attrs: dict,
+    ) -> ZarrOutput:
+        """
+        Create (or overwrite) the output at **path**.
+        :param path: path of the output
+        :param nodes: number of recorded nodes
+        :param records: number of time steps that will be written
+        :param attrs: attributes of the variable
+        :return: output
+        """
+        group = zarr.open_group(path, mode='w')
+        # as with NetCDFBackend, chunks are clamped to the dimensions
+        chunk_time = max(min(self.chunk_time, records), 1)
+        chunk_nodes = max(min(self.chunk_nodes or nodes, nodes), 1)
+
+        node = group.create_dataset('node', data=np.arange(0, nodes, dtype=np.int32))
+        node.attrs['_ARRAY_DIMENSIONS'] = ['node']
+
+        time_step = group.create_dataset(
+            'time_step',
+            shape=(records,),
+            chunks=(chunk_time,),
+            dtype=np.int32,
+            compressor=self.compressor,
+        )
+        time_step.attrs['_ARRAY_DIMENSIONS'] = ['time_step']
+
+        var = group.create_dataset(
+            'var',
+            shape=(records, nodes),
+            chunks=(chunk_time, chunk_nodes),
+            dtype=np.float32,
+            compressor=self.compressor,
+            fill_value=np.nan,
+        )
+        var.attrs.update({
+            key: value.item() if isinstance(value, np.generic) else value for key, value in attrs.items()
+        })
+        var.attrs['_ARRAY_DIMENSIONS'] = ['time_step', 'node']
+
+        group.attrs['records'] = 0
+
+        return ZarrOutput(group)
+
+    def open(
+            self,
+            path: str,
+    ) -> ZarrOutput:
+        """
+        Open the existing output at **path** to append to it.
+        """
+        return ZarrOutput(zarr.open_group(path, mode='r+'))
+
+    def records(
+            self,
+            path: str,
+    ) -> int:
+        """
+        Number of time steps written to the output at **path** (0 if missing or unreadable).
+        """
+        if not os.path.isdir(path):
+            return 0
+        try:
+            return zarr.open_group(path, mode='r').attrs.get('records', 0)
+        except (KeyError, ValueError):
+            return 0
+
+
+def get_backend(name: str = 'netcdf', **kwargs):
+    """
+    Return an output backend by name.
+    :param name: 'netcdf' or 'zarr'
+    :param kwargs: passed to the backend
+    :return: backend instance
+    """
+    if name == 'netcdf':
+        return NetCDFBackend(**kwargs)
+    if name == 'zarr':
+        return ZarrBackend(**kwargs)
+    raise ValueError('{} backend not supported!'.format(name))
@@ -0,0 +1,226 @@
+import typing as T
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from . import integrators
+from . import systems
+
+# maximum number of steps whose forcing values are evaluated at once
+FORCING_CHUNK_STEPS = 100000
+
+
+def _jit(func):
+    """
+    Compile **func** with numba in nopython mode, releasing the GIL (so that e.g. a background writer can run
+    meanwhile), if numba is available. Otherwise return **func** unchanged.
+    """
+    if numba is None:
+        return func
+    return numba.njit(cache=True, nogil=True)(func)
+
+
+def _check_samplers(
+        samplers: T.Sequence[T.Tuple[np.ndarray, int]],
+        first_step: int,
+        steps: int,
+):
+    """
+    Check that each sampler buffer is large enough to hold the states recorded between **first_step** and
+    **first_step** + **steps**.
+    """
+    for buffer, every in samplers:
+        if every <= 0:
+            raise ValueError('sampling interval must be positive, got {}'.format(every))
+        rows = -(-(first_step + steps) // every) - -(-first_step // every)
+        if len(buffer) < rows:
+            raise ValueError('sampler buffer has {} rows, {} needed'.format(len(buffer), rows))
+
+
+class PythonEngine:
+    """
+    Integrate step by step in Python, calling **int_method** and **system** of the simulator at each step.
+    Works with any system and integration method.
+    """
+
+    @property
+    def short_name(self):
+        return 'python'
+
+    @property
+    def long_name(self):
+        return 'Python step loop'
+
+    def __call__(
+            self,
+            simulator,
+            steps: int,
+            samplers: T.Sequence[T.Tuple[np.ndarray, int]] = (),
+            first_step: int = 0,
+    ):
+        """
+        Evolve the state of **simulator** by **steps** integration steps.
+        :param simulator: Simulator (or EnsembleSimulator) instance
+        :param steps: number of integration steps
+        :param samplers: sequence of (buffer, every) pairs. The state at each step multiple of **every** is written
+        into the next row of **buffer**, before integrating that step. Only the first buffer.shape[-1] nodes are kept.
+        :param first_step: index of the current step, used to place the recorded states
+        :return: None
+        """
+        _check_samplers(samplers, first_step, steps)
+
+        bases = [-(-first_step // every) for _, every in samplers]
+
+        coords = simulator.system_state.coords
+        for offset, forcing_table in simulator.forcing_chunks(steps):
+            for k in range(len(forcing_table)):
+                step = first_step + offset + k
+                for (buffer, every), base in zip(samplers, bases):
+                    if step % every == 0:
+                        buffer[step // every - base] = np.asarray(coords)[..., :buffer.shape[-1]]
+                coords = simulator.advance(coords, forcing_table[k])
+
+        simulator.system_state.coords = simulator.detach_coords(coords)
+        simulator.system_state.step += steps
+
+
+@_jit
+def _lorenz96_rk4_step(x, forcing, hs, k1, k2, k3, k4, xk):
+    """
+    One 4th order Runge-Kutta step of Lorenz-96, in place on **x**. The operations are carried out in the same
+    order as in systems.Lorenz96 and integrators.RungeKutta4.
+    """
+    n = x.shape[0]
+    for i in range(n):
+        k1[i] = ((x[(i + 1) % n] - x[i - 2]) * x[i - 1] - x[i] + forcing) * hs
+    for i in range(n):
+        xk[i] = x[i] + k1[i] * 0.5
+    for i in range(n):
+        k2[i] = ((xk[(i + 1) % n] - xk[i - 2]) * xk[i - 1] - xk[i] + forcing) * hs
+    for i in range(n):
+        xk[i] = x[i] + k2[i] * 0.5
+    for i in range(n):
+        k3[i] = ((xk[(i + 1) % n] - xk[i - 2]) * xk[i - 1] - xk[i] + forcing) * hs
+    for i in range(n):
+        xk[i] = x[i] + k3[i]
+    for i in range(n):
+        k4[i] = ((xk[(i + 1) % n] - xk[i - 2]) * xk[i - 1] - xk[i] + forcing) * hs
+    for i in range(n):
+        x[i] = x[i] + (k1[i] + 2 * (k2[i] + k3[i]) + k4[i]) / 6
+
+
+@_jit
+def _lorenz96_rk4(x, forcing_table, hs, first_step, buffer_a, every_a, buffer_b, every_b):
+    """
+    Integrate the (members x nodes) state **x** in place for len(**forcing_table**) steps, recording states into
+    the (rows x members x width) buffers every **every_a** and **every_b** steps (0 to disable).
+    """
+    members, nodes = x.shape
+    k1 = np.empty(nodes)
+    k2 = np.empty(nodes)
+    k3 = np.empty(nodes)
+    k4 = np.empty(nodes)
+    xk = np.empty(nodes)
+
+    base_a = -(-first_step // every_a) if every_a > 0 else 0
+    base_b = -(-first_step // every_b) if every_b > 0 else 0
+
+    for k in range(forcing_table.shape[0]):
+        step = first_step + k
+        if every_a > 0 and step % every_a == 0:
+            row = step // every_a - base_a
+            for m in range(members):
+                for i in range(buffer_a.shape[2]):
+                    buffer_a[row, m, i] = x[m, i]
+        if every_b > 0 and step % every_b == 0:
+            row = step // every_b - base_b
+            for m in range(members):
+                for i in range(buffer_b.shape[2]):
+                    buffer_b[row, m, i] = x[m, i]
+        for m in range(members):
+            if forcing_table.shape[1] == 1:
+                forcing = forcing_table[k, 0]
+            else:
+                forcing = forcing_table[k, m]
+            _lorenz96_rk4_step(x[m], forcing, hs, k1, k2, k3, k4, xk)
+
+
+class NumbaEngine(PythonEngine):
+    """
+    Integrate many steps in a single call of a numba-compiled kernel, writing the sampled states straight into the
+    sampler buffers. Compiled kernels are available for Lorenz96 + RungeKutta4, with at most two samplers; any other
+    combination (or a missing numba installation) falls back to PythonEngine.
+    """
+
+    @property
+    def short_name(self):
+        return 'numba'
+
+    @property
+    def long_name(self):
+        return 'Numba compiled kernel'
+
+    @staticmethod
+    def supports(simulator, samplers=()):
+        return numba is not None \
+               and isinstance(simulator.system, systems.Lorenz96) \
+               and isinstance(simulator.int_method, integrators.RungeKutta4) \
+               and len(samplers) <= 2
+
+    def __call__(
+            self,
+            simulator,
+            steps: int,
+            samplers: T.Sequence[T.Tuple[np.ndarray, int]] = (),
+            first_step: int = 0,
+    ):
+        if not self.supports(simulator, samplers):
+            return super().__call__(simulator, steps, samplers, first_step)
+
+        _check_samplers(samplers, first_step, steps)
+
+        coords = np.array(simulator.system_state.coords, dtype=np.float64)
+        x = coords.reshape(-1, coords.shape[-1])
+
+        kernel_samplers = []
+        for buffer, every in samplers:
+            # a view with an explicit members axis, so that the kernel writes into the caller's buffer
+            kernel_samplers.append((buffer[:, None, :] if coords.ndim == 1 else buffer, every))
+        while len(kernel_samplers) < 2:
+            kernel_samplers.append((np.empty((0, 1, 1), dtype=np.float64), 0))
+
+        bases = [-(-first_step // every) if every > 0 else 0 for _, every in kernel_samplers]
+
+        for offset, forcing_table in simulator.forcing_chunks(steps):
+            forcing_table = np.asarray(forcing_table, dtype=np.float64).reshape(len(forcing_table), -1)
+            chunk_first = first_step + offset
+            # rows of the buffers from the first state recorded in this chunk
+            (buffer_a, every_a), (buffer_b, every_b) = [
+                (buffer[-(-chunk_first // every) - base:] if every > 0 else buffer, every)
+                for (buffer, every), base in zip(kernel_samplers, bases)
+            ]
+            _lorenz96_rk4(x, forcing_table, simulator.increment, chunk_first, buffer_a, every_a, buffer_b, every_b)
+
+        simulator.system_state.coords = coords
+        simulator.system_state.step += steps
+
+
+def get_engine(name: str = 'auto'):
+    """
+    Return an integration engine by name.
+    :param name: 'python', 'numba' or 'auto' (numba if installed, else python)
+    :return: engine instance
+    """
+    if name == 'python':
+        return PythonEngine()
+    if name == 'numba':
+        if numba is None:
+            raise ImportError('numba is not installed')
+        return NumbaEngine()
+    if name == 'auto':
+        return NumbaEngine() if numba is not None else PythonEngine()
+    raise ValueError('{} engine not supported!'.format(name))
@@ -1,5 +1,7 @@
 import math
 
+import numpy as np
+
 
 class Forcing:
 
@@ -11,6 +13,38 @@ class Forcing:
     def long_name(self):
         return self._long_name
 
+    def parameters(self) -> dict:
+        """
+        Class and parameters of the forcing as plain (JSON serializable) values, e.g. to check that a checkpoint
+        was written with the same forcing.
+        """
+        def plain(value):
+            if isinstance(value, Forcing):
+                return value.parameters()
+            if isinstance(value, (list, tuple)):
+                return [plain(item) for item in value]
+            if isinstance(value, (np.ndarray, np.generic)):
+                return value.tolist()
+            return value
+
+        parameters = {key: plain(value) for key, value in vars(self).items() if not key.startswith('_')}
+        parameters['class'] = type(self).__name__
+
+        return parameters
+
+    def evaluate(
+            self,
+            times: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Evaluate the forcing at all **times** at once. Subclasses override this with a single NumPy expression;
+        this fallback calls the forcing at each time.
+        :param times: array of times
+        :return: float64 array of forces, with the shape of **times**
+        """
+        times = np.asarray(times, dtype=np.float64)
+        return np.array([self(time) for time in times.ravel()], dtype=np.float64).reshape(times.shape)
+
 
 class ConstantForcing(Forcing):
     """
@@ -35,6 +69,12 @@ class ConstantForcing(Forcing):
     ):
         return self.force_intensity
 
+    def evaluate(
+            self,
+            times: np.ndarray,
+    ) -> np.ndarray:
+        return np.full(np.shape(times), self.force_intensity, dtype=np.float64)
+
 
 class DeltaForcing(Forcing):
     """
@@ -75,6 +115,15 @@ class DeltaForcing(Forcing):
         force = self.force_intensity_base + self.force_intensity_delta*math.isclose(time, self.activation_time)
         return force
 
+    def evaluate(
+            self,
+            times: np.ndarray,
+    ) -> np.ndarray:
+        times = np.asarray(times, dtype=np.float64)
+        # same test as math.isclose (symmetric, rel_tol=1e-9, abs_tol=0); np.isclose is asymmetric
+        active = np.abs(times - self.activation_time) <= 1e-9 * np.maximum(np.abs(times), abs(self.activation_time))
+        return self.force_intensity_base + self.force_intensity_delta*active
+
 
 class StepForcing(Forcing):
     """
@@ -115,6 +164,13 @@ class StepForcing(Forcing):
         force = self.force_intensity_base + self.force_intensity_delta*(time >= self.activation_time)
         return force
 
+    def evaluate(
+            self,
+            times: np.ndarray,
+    ) -> np.ndarray:
+        times = np.asarray(times, dtype=np.float64)
+        return self.force_intensity_base + self.force_intensity_delta*(times >= self.activation_time)
+
 
 class LinearForcing(Forcing):
     """
@@ -168,6 +224,14 @@ class LinearForcing(Forcing):
 
         return force
 
+    def evaluate(
+            self,
+            times: np.ndarray,
+    ) -> np.ndarray:
+        # before activation the clipped elapsed time is 0, after deactivation it is frozen
+        times = np.clip(np.asarray(times, dtype=np.float64), self.activation_time, self.deactivation_time)
+        return self.force_intensity_base + self.linear_coefficient * (times - self.activation_time)
+
 
 class SinusoidalForcing(Forcing):
     """
@@ -227,3 +291,113 @@ class SinusoidalForcing(Forcing):
 
         return force
 
+    def evaluate(
+            self,
+            times: np.ndarray,
+    ) -> np.ndarray:
+        # before activation the clipped elapsed time is 0, after deactivation it is frozen
+        times = np.clip(np.asarray(times, dtype=np.float64), self.activation_time, self.deactivation_time)
+        return self.force_intensity_base + self.epsilon * np.sin(self.omega * (times - self.activation_time))
+
+
+class MemberForcing(Forcing):
+    """
+    Define a different forcing for each member of an ensemble: member m is forced by
+    **forcings**[**index**[m]]. Each distinct forcing is evaluated once per time, and the values are spread over
+    the members as a (members x 1) column, which broadcasts over the (members x nodes) ensemble state.
+    """
+    def __init__(
+            self,
+            forcings: list,
+            index: list,
+    ):
+        """
+        :param forcings: distinct forcings
+        :param index: index in **forcings** of the forcing of each member
+        """
+        self.forcings = list(forcings)
+        self.index = np.asarray(index, dtype=np.int64)
+
+        if self.index.min() < 0 or self.index.max() >= len(self.forcings):
+            raise ValueError('member forcing index out of range 0..{}'.format(len(self.forcings) - 1))
+
+        self._short_name = 'MF_{}'.format('_'.join(forcing.short_name for forcing in self.forcings))
+        self._long_name = 'Member Forcing ({})'.format(', '.join(forcing.long_name for forcing in self.forcings))
+
+    @property
+    def members(self):
+        return len(self.index)
+
+    def member_forcing(self, member: int) -> Forcing:
+        """
+        Forcing of **member**.
+        """
+        return self.forcings[self.index[member]]
+
+    def __call__(
+            self,
+            time: float
+    ):
+        forces = np.array([forcing(time) for forcing in self.forcings], dtype=np.float64)
+        return forces[self.index][:, None]
+
+    def evaluate(
+            self,
+            times: np.ndarray,
+    ) -> np.ndarray:
+        """
+        :return: float64 array of forces, of shape times.shape + (members, 1)
+        """
+        times = np.asarray(times, dtype=np.float64)
+        forces = np.stack([forcing.evaluate(times) for forcing in self.forcings], axis=-1)
+        return forces[..., self.index, None]
+
+
+def build_forcing(
+        forcing_id: str,
+        params: list,
+):
+    """
+    Build a forcing from its id and (ordered) parameters, as given on the command line of the simulation scripts.
+    Non-constant forcings are activated at t=0; linear and sinusoidal ones are deactivated at t=100.
+    :param forcing_id: one of 'constant', 'delta', 'step', 'linear', 'sinusoidal'
+    :param params: forcing parameters (base intensity first)
+    :return: Forcing instance
+    """
+    params = [float(param) for param in params]
+
+    if forcing_id == 'constant':
+        force = ConstantForcing(
+            force_intensity=params[0]
+        )
+    elif forcing_id == 'delta':
+        force = DeltaForcing(
+            activation_time=0,
+            force_intensity_base=params[0],
+            force_intensity_delta=params[1]
+        )
+    elif forcing_id == 'step':
+        force = StepForcing(
+            activation_time=0,
+            force_intensity_base=params[0],
+            force_intensity_delta=params[1]
+        )
+    elif forcing_id == 'linear':
+        force = LinearForcing(
+            activation_time=0,
+            deactivation_time=100,
+            force_intensity_base=params[0],
+            linear_coefficient=params[1]
+        )
+    elif forcing_id == 'sinusoidal':
+        force = SinusoidalForcing(
+            activation_time=0,
+            deactivation_time=100,
+            force_intensity_base=params[0],
+            epsilon=params[1],
+            omega=params[2]
+        )
+    else:
+        raise ValueError('{} forcing not supported!'.format(forcing_id))
+
+    return force
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class IntegrationMethod:
 
     # def __init__(self, x, f, fx, hs):
@@ -13,7 +16,8 @@ class IntegrationMethod:
     #     self.fx = fx
     #     self.hs = hs
 
-    pass
+    # whether __call__ accepts an out= array (which may be the input coordinates)
+    in_place = False
 
 class RungeKutta4(IntegrationMethod):
 
@@ -41,3 +45,57 @@ class RungeKutta4(IntegrationMethod):
         x = x + (k1 + 2 * (k2 + k3) + k4) / 6
 
         return x
+
+
+class RungeKutta4InPlace(RungeKutta4):
+    """
+    4th order Runge-Kutta without temporary arrays. Stages are stored in buffers given by the caller (see
+    stage_buffers), so that an instance holds no state and can be shared between simulators or threads. The system
+    must accept an out= array. Results are identical to RungeKutta4.
+    """
+
+    in_place = True
+
+    @staticmethod
+    def stage_buffers(x):
+        """
+        Allocate the stage buffers of steps on coordinates shaped like **x**, to be passed as stages= to each step.
+        """
+        return tuple(np.empty(np.shape(x)) for _ in range(5))
+
+    def __call__(self, x, f, fx, hs, out=None, stages=None):
+        """
+        This method implement 4th order Runge-Kutta integration method.
+        :param out: array where coordinates at time t1 are written. It may be **x** itself.
+        :param stages: stage buffers (see stage_buffers). If None, allocated for this step.
+        :return: coordinates at time t1 = t0 + hs
+        """
+        x = np.asarray(x, dtype=np.float64)
+        if out is None:
+            out = np.empty_like(x)
+
+        k1, k2, k3, k4, xk = self.stage_buffers(x) if stages is None else stages
+
+        fx(x, f, out=k1)
+        k1 *= hs
+        np.multiply(k1, 0.5, out=xk)
+        xk += x
+        fx(xk, f, out=k2)
+        k2 *= hs
+        np.multiply(k2, 0.5, out=xk)
+        xk += x
+        fx(xk, f, out=k3)
+        k3 *= hs
+        np.add(x, k3, out=xk)
+        fx(xk, f, out=k4)
+        k4 *= hs
+
+        # (k1 + 2 * (k2 + k3) + k4) / 6, accumulated in k1
+        k2 += k3
+        k2 *= 2
+        k1 += k2
+        k1 += k4
+        k1 /= 6
+        np.add(x, k1, out=out)
+
+        return out
@@ -3,17 +3,69 @@ import typing as T
 import numpy as np
 
 
+def _apply(
+        compute: T.Callable,
+        data: T.Union[xr.Dataset, xr.DataArray, np.ndarray],
+        dtype=None,
+):
+    """
+    Apply the raw ndarray function **compute** to **data**. DataArrays go through xr.apply_ufunc, so that dask-backed
+    data get a single (lazy, chunk by chunk) node per observable. Datasets are mapped variable by variable.
+    :param dtype: output dtype. If None, the dtype of the data (of each variable for a Dataset).
+    """
+    if isinstance(data, xr.Dataset):
+        return data.map(lambda var: _apply(compute, var, dtype), keep_attrs=True)
+    if isinstance(data, xr.DataArray):
+        output_dtype = data.dtype if dtype is None else dtype
+        return xr.apply_ufunc(compute, data, dask='parallelized', output_dtypes=[output_dtype], keep_attrs=True)
+    return compute(np.asarray(data))
+
+
+def _operand(
+        observable,
+        data: np.ndarray,
+) -> T.Tuple[np.ndarray, float]:
+    """
+    Return (operand, scale) such that observable(data) > t exactly when operand > scale * t (see
+    Energy.threshold_operand). Observables without threshold_operand are computed as they are.
+    """
+    if hasattr(observable, 'threshold_operand'):
+        return observable.threshold_operand(data)
+    return np.asarray(observable.compute(data) if hasattr(observable, 'compute') else observable(data)), 1.
+
+
+def _indicator(mask: np.ndarray) -> np.ndarray:
+    """
+    0/1 int8 view of the boolean **mask** (no copy). int8 rather than uint8 or bool: differences of indicators
+    (forced - unforced responses) are then -1, 0 or 1, instead of wrapping around to 255 or raising.
+    """
+    return mask.view(np.int8)
+
+
 class Energy:
 
     def __call__(
             self,
-            data: xr.DataArray
+            data: T.Union[xr.Dataset, xr.DataArray, np.ndarray]
     ):
 
-        obs = 0.5*(data**2)
+        return _apply(self.compute, data)
+
+    @staticmethod
+    def compute(data: np.ndarray) -> np.ndarray:
+        """
+        0.5 * data**2 on a plain array, with a single temporary.
+        """
+        obs = np.square(data)
+        obs *= 0.5
 
         return obs
 
+    @staticmethod
+    def threshold_operand(data: np.ndarray) -> T.Tuple[np.ndarray, float]:
+        # 0.5 * x**2 > t  <=>  x**2 > 2 * t (scaling by 2 is exact), which saves the product
+        return np.square(data), 2.
+
     @property
     def short_name(self):
 
@@ -24,13 +76,21 @@ class Position:
 
     def __call__(
             self,
-            data: xr.DataArray
+            data: T.Union[xr.Dataset, xr.DataArray, np.ndarray]
     ):
 
         obs = data
 
         return obs
 
+    @staticmethod
+    def compute(data: np.ndarray) -> np.ndarray:
+        return data
+
+    @staticmethod
+    def threshold_operand(data: np.ndarray) -> T.Tuple[np.ndarray, float]:
+        return data, 1.
+
     @property
     def short_name(self):
 
@@ -52,21 +112,23 @@ class Bin:
 
     def __call__(
             self,
-            data: xr.DataArray
+            data: T.Union[xr.Dataset, xr.DataArray, np.ndarray]
     ):
 
-        data = self.observable(data)
-        ones = xr.ones_like(data)
+        return _apply(self.compute, data, np.int8)
 
-        if len(self.threshold) == 1:
-            obs = ones.where(data > self.threshold[0], 0)
-        else:
-            obs1 = ones.where(data > self.threshold[0], 0)
-            obs2 = ones.where(data <= self.threshold[1], 0)
+    def compute(self, data: np.ndarray) -> np.ndarray:
+        """
+        int8 indicator of threshold[0] < observable(data) (<= threshold[1]), computed on a plain array.
+        """
+        return self.from_operand(*_operand(self.observable, data))
 
-            obs = obs1 * obs2
+    def from_operand(self, operand: np.ndarray, scale: float) -> np.ndarray:
+        mask = np.greater(operand, np.float64(scale * self.threshold[0]))
+        if len(self.threshold) > 1:
+            np.logical_and(mask, np.less_equal(operand, np.float64(scale * self.threshold[1])), out=mask)
 
-        return obs
+        return _indicator(mask)
 
     @property
     def short_name(self):
@@ -91,15 +153,19 @@ class Below:
 
     def __call__(
             self,
-            data: xr.DataArray
+            data: T.Union[xr.Dataset, xr.DataArray, np.ndarray]
     ):
 
-        data = self.observable(data)
-        ones = xr.ones_like(data)
+        return _apply(self.compute, data, np.int8)
 
-        obs = ones.where(data < self.threshold[0], 0)
+    def compute(self, data: np.ndarray) -> np.ndarray:
+        """
+        int8 indicator of observable(data) < threshold[0], computed on a plain array.
+        """
+        return self.from_operand(*_operand(self.observable, data))
 
-        return obs
+    def from_operand(self, operand: np.ndarray, scale: float) -> np.ndarray:
+        return _indicator(np.less(operand, np.float64(scale * self.threshold[0])))
 
     @property
     def short_name(self):
@@ -122,15 +188,89 @@ class Exceed:
 
     def __call__(
             self,
-            data: xr.DataArray
+            data: T.Union[xr.Dataset, xr.DataArray, np.ndarray]
     ):
 
-        data = self.observable(data)
-        obs = xr.where(data > self.threshold[0], 1, 0)
+        return _apply(self.compute, data, np.int8)
 
-        return obs
+    def compute(self, data: np.ndarray) -> np.ndarray:
+        """
+        int8 indicator of observable(data) > threshold[0], computed on a plain array.
+        """
+        return self.from_operand(*_operand(self.observable, data))
+
+    def from_operand(self, operand: np.ndarray, scale: float) -> np.ndarray:
+        return _indicator(np.greater(operand, np.float64(scale * self.threshold[0])))
 
     @property
     def short_name(self):
 
         return f'{self.observable.short_name}_exceed_{np.round(self.threshold_q[0], 3):02}q'
+
+
+class ObservableSet:
+    """
+    Evaluate many observables over the same data, e.g. energy, position and a sweep of thresholds on both, so that
+    each member file is read once for all of them. Quantities shared by several observables (the observable a
+    threshold is applied to, or its threshold operand) are computed once per call.
+    """
+
+    def __init__(
+            self,
+            observables: T.Sequence,
+    ):
+        """
+        :param observables: observables (short names must be unique)
+        """
+        self.observables = list(observables)
+
+        short_names = self.short_names
+        if len(set(short_names)) != len(short_names):
+            raise ValueError('observables with the same short name: {}'.format(short_names))
+
+    @property
+    def short_names(self) -> T.List[str]:
+        return [observable.short_name for observable in self.observables]
+
+    def __len__(self):
+        return len(self.observables)
+
+    def __iter__(self):
+        return iter(self.observables)
+
+    def __call__(
+            self,
+            data: T.Union[xr.Dataset, xr.DataArray, np.ndarray]
+    ) -> T.Dict[str, T.Union[xr.Dataset, xr.DataArray, np.ndarray]]:
+        """
+        :return: dict of observables values, keyed by short name
+        """
+        if not isinstance(data, (xr.Dataset, xr.DataArray)):
+            return self.compute(data)
+
+        return {observable.short_name: observable(data) for observable in self.observables}
+
+    def compute(
+            self,
+            data: np.ndarray,
+    ) -> T.Dict[str, np.ndarray]:
+        """
+        Evaluate all observables on a plain array.
+        :return: dict of observables values, keyed by short name
+        """
+        data = np.asarray(data)
+        values = {}
+        operands = {}
+
+        for observable in self.observables:
+            if hasattr(observable, 'from_operand'):
+                key = observable.observable.short_name
+                if key not in operands:
+                    operands[key] = _operand(observable.observable, data)
+                values[observable.short_name] = observable.from_operand(*operands[key])
+            elif hasattr(observable, 'compute'):
+                values[observable.short_name] = observable.compute(data)
+            else:
+                values[observable.short_name] = np.asarray(observable(data))
+
+        return values
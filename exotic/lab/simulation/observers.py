@@ -0,0 +1,160 @@
+import abc
+import typing as T
+
+import numpy as np
+import xarray as xr
+
+from . import observables
+from .. import response
+
+
+class Observer(abc.ABC):
+    """
+    Hook receiving the records of a SimulationRunner output ('one' or 'all') chunk by chunk, straight from memory,
+    whether or not the output is also written to file. Subclasses implement __call__, and optionally start and close.
+    """
+
+    # precision of the records received (float32 is that of the output; float64 that of the state)
+    dtype = np.float32
+
+    def __init__(
+            self,
+            output: str = 'one',
+    ):
+        """
+        :param output: output whose records are observed ('one' or 'all')
+        """
+        self.output = output
+
+    def start(self, runner):
+        """
+        Called by **runner** before the first chunk.
+        """
+        pass
+
+    @abc.abstractmethod
+    def __call__(
+            self,
+            start: int,
+            time_steps: np.ndarray,
+            records: np.ndarray,
+    ):
+        """
+        Called once per simulated chunk.
+        :param start: index of the first record of the chunk
+        :param time_steps: time steps of the records
+        :param records: records of precision **dtype** (or higher), (records x nodes), or (records x members x nodes)
+        for ensembles
+        """
+
+    def close(self):
+        """
+        Called by the runner once the simulation is over.
+        """
+        pass
+
+
+class ObservableAccumulator(Observer):
+    """
+    Accumulate ensemble statistics (mean, variance, count, confidence band, see response.RunningStats) of one or
+    more observables at each recorded time step, over the members of an EnsembleSimulator and over successive runs
+    (e.g. one per member) fed to the same accumulator. Nothing needs to be written to or read from file.
+    """
+
+    def __init__(
+            self,
+            observable,
+            output: str = 'one',
+            level: float = 0.95,
+    ):
+        """
+        :param observable: observable or ObservableSet (from lab.simulation.observables)
+        :param output: output whose records are observed ('one' or 'all')
+        :param level: confidence level of the bands
+        """
+        super().__init__(output)
+        if isinstance(observable, observables.ObservableSet):
+            self.observables = observable
+        else:
+            self.observables = observables.ObservableSet([observable])
+        self.level = level
+        self.stats_set = None
+        self.time_steps = None
+
+    def start(self, runner):
+        every, nodes = runner._outputs()[self.output]
+        records = runner.expected_records()[self.output]
+
+        if self.stats_set is None:
+            self.stats_set = {
+                short_name: response.RunningStats((records, nodes)) for short_name in self.observables.short_names
+            }
+            self.time_steps = np.arange(records) * every
+        elif len(self.time_steps) != records:
+            raise ValueError('{} records expected by an accumulator of {}'.format(records, len(self.time_steps)))
+
+    def __call__(
+            self,
+            start: int,
+            time_steps: np.ndarray,
+            records: np.ndarray,
+    ):
+        # members first, as samples of the statistics
+        block = np.moveaxis(records, 1, 0) if records.ndim == 3 else records[None]
+        values = self.observables.compute(block)
+
+        index = slice(start, start + len(records))
+        for short_name, stats in self.stats_set.items():
+            stats.update(values[short_name], index)
+
+    def to_dataset(
+            self,
+            short_name: str = None,
+    ) -> xr.Dataset:
+        """
+        Statistics of an observable over (time_step x node) (see response.stats_dataset).
+        :param short_name: observable (with an ObservableSet). If None, the first one.
+        """
+        if short_name is None:
+            short_name = self.observables.short_names[0]
+
+        return response.stats_dataset(self.stats_set[short_name], self.time_steps, short_name, self.level)
+
+    def to_datasets(self) -> T.Dict[str, xr.Dataset]:
+        """
+        Statistics of all observables (see to_dataset), keyed by short name.
+        """
+        return {short_name: self.to_dataset(short_name) for short_name in self.observables.short_names}
+
+
+class ResponseAccumulator(ObservableAccumulator):
+    """
+    Accumulate the statistics of the response observable(forced) - observable(control) of a PairedSimulator, pair
+    by pair, at each recorded time step. Forced and control trajectories come from the same batched state, so
+    neither needs to be written or read back, and their difference is taken at the (float64) precision of the state.
+    """
+
+    dtype = np.float64
+
+    def start(self, runner):
+        self.pairs = getattr(runner.simulator, 'pairs', None)
+        if self.pairs is None:
+            raise ValueError('ResponseAccumulator needs a PairedSimulator')
+
+        super().start(runner)
+
+    def __call__(
+            self,
+            start: int,
+            time_steps: np.ndarray,
+            records: np.ndarray,
+    ):
+        block = np.moveaxis(records, 1, 0)
+        forced = self.observables.compute(block[:self.pairs])
+        control = self.observables.compute(block[self.pairs:])
+
+        index = slice(start, start + len(records))
+        for short_name, stats in self.stats_set.items():
+            difference = np.asarray(forced[short_name], dtype=np.float64)
+            difference -= control[short_name]
+            stats.update(difference, index)
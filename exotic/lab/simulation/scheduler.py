@@ -0,0 +1,198 @@
+import os
+import typing as T
+import concurrent.futures
+
+import numpy as np
+import xarray as xr
+
+from . import backends
+from . import engines
+from . import forcings
+from . import integrators
+from . import simulation
+from . import systems
+
+
+def available_cpus() -> int:
+    """
+    Number of cores this process may run on (the cores allocated by the scheduler on a cluster node).
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _run_member(scheduler, member, coords, time_step_real):
+    return scheduler.run_member(member, coords, time_step_real)
+
+
+class EnsembleScheduler:
+    """
+    Run the members of a forced ensemble in parallel over a process pool. Member i starts from the initial
+    condition taken i * **time_between_init_cond** time units along the initial conditions run.
+    Members whose output files are already complete are skipped; failed members are retried.
+    """
+
+    def __init__(
+            self,
+            forcing_id: str,
+            forcing_params: list,
+            initial_conditions_path: str,
+            time_between_init_cond: float,
+            integration_time: float,
+            write_one_every: float,
+            write_all_every: float,
+            data_base_path: str = simulation.DATA_BASE_PATH,
+            chunk_length_time: int = 1000,
+            engine: str = 'auto',
+            backend: str = 'netcdf',
+            backend_options: dict = None,
+            max_workers: int = None,
+            retries: int = 2,
+    ):
+        """
+        :param forcing_id: forcing type (see forcings.build_forcing)
+        :param forcing_params: forcing parameters (see forcings.build_forcing)
+        :param initial_conditions_path: netcdf with all nodes of the initial conditions run
+        :param time_between_init_cond: time between initial conditions of consecutive members
+        :param integration_time: total time of integration of each member
+        :param write_one_every: time between records of one (first) node
+        :param write_all_every: time between records of all nodes
+        :param data_base_path: base path were data are going to be saved
+        :param chunk_length_time: time after which each member writes on netcdf and frees memory
+        :param engine: integration engine name (see engines.get_engine)
+        :param backend: output backend name (see backends.get_backend)
+        :param backend_options: options of the backend (e.g. chunking and compression)
+        :param max_workers: number of worker processes. If None, one per available core.
+        :param retries: number of further attempts for a failed member
+        """
+        self.forcing_id = forcing_id
+        self.forcing_params = list(forcing_params)
+        self.initial_conditions_path = initial_conditions_path
+        self.time_between_init_cond = time_between_init_cond
+        self.integration_time = integration_time
+        self.write_one_every = write_one_every
+        self.write_all_every = write_all_every
+        self.data_base_path = data_base_path
+        self.chunk_length_time = chunk_length_time
+        self.engine = engine
+        self.backend = backend
+        self.backend_options = backend_options or {}
+        self.max_workers = max_workers or available_cpus()
+        self.retries = retries
+
+        # fail early on unsupported forcings
+        forcings.build_forcing(self.forcing_id, self.forcing_params)
+
+    def build_runner(
+            self,
+            coords: np.ndarray = None,
+    ) -> simulation.SimulationRunner:
+        """
+        Build the SimulationRunner of a member starting from **coords**.
+        """
+        simulator = simulation.Simulator(
+            system_state=simulation.SystemState(coords=coords),
+            forcing=forcings.build_forcing(self.forcing_id, self.forcing_params),
+            int_method=integrators.RungeKutta4(),
+            system=systems.Lorenz96(),
+            engine=engines.get_engine(self.engine),
+        )
+
+        return simulation.SimulationRunner(
+            simulator=simulator,
+            integration_time=self.integration_time,
+            chunk_length_time=self.chunk_length_time,
+            write_all_every=self.write_all_every,
+            write_one_every=self.write_one_every,
+            backend=backends.get_backend(self.backend, **self.backend_options),
+        )
+
+    @staticmethod
+    def member_suffix(member: int) -> str:
+        return '{:06}'.format(member)
+
+    def is_complete(
+            self,
+            member: int,
+    ) -> bool:
+        """
+        Check whether all output files of **member** exist and contain every expected record.
+        """
+        runner = self.build_runner()
+        outfiles = runner.outfile_paths(self.data_base_path, self.member_suffix(member))
+        records = runner.expected_records()
+
+        for key, outfile in outfiles.items():
+            if runner.backend.records(outfile) != records[key]:
+                return False
+
+        return True
+
+    def run_member(
+            self,
+            member: int,
+            coords: np.ndarray,
+            time_step_real: int,
+    ) -> dict:
+        """
+        Integrate a single member and write its output.
+        :return: out file names
+        """
+        runner = self.build_runner(coords)
+
+        return runner.run(
+            data_base_path=self.data_base_path,
+            custom_suffix=self.member_suffix(member),
+            custom_attrs={'time_step_0_real': time_step_real}
+        )
+
+    def run(
+            self,
+            members: T.Iterable[int],
+            callback: T.Callable = None,
+    ) -> dict:
+        """
+        Run **members** over the process pool.
+        :param members: indices of the members to run
+        :param callback: if given, called as callback(member, result, error) each time a member is done (or has
+        finally failed)
+        :return: dict of results keyed by member: out file names, None if skipped, or the last exception raised
+        """
+        results = {}
+        to_run = []
+        for member in members:
+            if self.is_complete(member):
+                results[member] = None
+                if callback is not None:
+                    callback(member, None, None)
+            else:
+                to_run.append(member)
+
+        if not to_run:
+            return results
+
+        with xr.open_dataarray(self.initial_conditions_path) as initial_conditions:
+            integration_step = initial_conditions.integration_step
+
+            def submit(executor, member):
+                time_step_real = int(member * self.time_between_init_cond / integration_step)
+                coords = initial_conditions.sel(time_step=time_step_real).values
+                return executor.submit(_run_member, self, member, coords, time_step_real)
+
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {submit(executor, member): (member, 0) for member in to_run}
+                while futures:
+                    done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        member, attempt = futures.pop(future)
+                        error = future.exception()
+                        if error is not None and attempt < self.retries:
+                            futures[submit(executor, member)] = (member, attempt + 1)
+                            continue
+                        results[member] = future.result() if error is None else error
+                        if callback is not None:
+                            callback(member, results[member], error)
+
+        return results
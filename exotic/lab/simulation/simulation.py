@@ -1,8 +1,13 @@
 import numpy as np
-import netCDF4 as nc
 import os
 import datetime
+import json
+import queue
+import threading
+import typing as T
 
+from . import backends
+from . import engines
 from . import forcings
 from . import integrators
 from . import systems
@@ -10,21 +15,65 @@ from . import systems
 DATA_BASE_PATH = '../../../../data/'
 
 
+def step_time(
+        steps,
+        increment: float,
+):
+    """
+    Time elapsed after **steps** integration steps of length **increment**. When 1/**increment** is an integer
+    (e.g. dt=0.01 or dt=0.001), the division steps/(1/increment) gives the float closest to the exact decimal time,
+    so that times computed from step counters do not drift and need no rounding.
+    :param steps: number of steps (int or integer array)
+    :param increment: time increment (dt)
+    :return: elapsed time (float or float array)
+    """
+    rate = round(1 / increment)
+    if rate > 0 and rate * increment == 1:
+        return steps / rate
+    return steps * increment
+
+
 class SystemState:
 
-    def __init__(self, coords=(0, 0, 0), time=0):
+    def __init__(self, coords=(0, 0, 0), time=0, step=0, increment=None):
         """
 
         :param coords: coordinates
-        :param time: time
+        :param time: time at step 0
+        :param step: number of integration steps taken since **time**
+        :param increment: time increment of each step (set by Simulator)
         """
         self.coords = coords
-        self.time = time
+        self.time_origin = time
+        self.step = step
+        self.increment = increment
 
     def __repr__(self):
         return "coordinates: {}\n" \
                "time: {}".format(self.coords, self.time)
 
+    @property
+    def time(self):
+        """
+        Current time, derived from the integer step counter.
+        """
+        if self.step == 0 or self.increment is None:
+            return self.time_origin
+        return self.time_origin + step_time(self.step, self.increment)
+
+    @time.setter
+    def time(self, time):
+        self.time_origin = time
+        self.step = 0
+
+    def set_increment(self, increment: float):
+        """
+        Count steps of length **increment** from now on, starting from the current time.
+        """
+        if increment != self.increment:
+            self.time = self.time
+            self.increment = increment
+
     @property
     def energy(self):
         return np.sum(0.5*(np.square(self.coords)))
@@ -50,7 +99,8 @@ class Simulator:
             int_method=integrators.RungeKutta4(),
             system_state=SystemState(),
             increment: float = 0.01,
-            forcing=forcings.ConstantForcing()
+            forcing=forcings.ConstantForcing(),
+            engine=None,
     ):
         """
         :param system: first-order differential equations system
@@ -58,13 +108,19 @@ class Simulator:
         :param: system_state: instance of SystemState class
         :param: increment: time increment (dt)
         :param: forcing: external forcing
+        :param: engine: integration engine (from lab.simulation.engines) used to run many steps in one call.
+        If None, integrate step by step.
         """
         self.system = system
         self.int_method = int_method
         self.system_state = system_state
         self.increment = increment
         self.forcing = forcing
+        self.engine = engine
+        self._coords_buffer = None
+        self._stage_buffers = None
 
+        self.system_state.set_increment(self.increment)
         self.init_time = self.system_state.time
 
     def __repr__(self):
@@ -95,14 +151,17 @@ class Simulator:
 
         integration_steps = int(integration_time/self.increment)
 
-        for _ in np.arange(0, integration_steps):
-            self.system_state.coords = self.int_method(
-                self.system_state.coords,
-                self.forcing(self.system_state.time),
-                self.system,
-                self.increment
-            )
-            self.system_state.time = round(self.system_state.time + self.increment, 2)
+        if self.engine is not None:
+            self.engine(self, integration_steps)
+            return
+
+        coords = self.system_state.coords
+        for _, forcing_table in self.forcing_chunks(integration_steps):
+            for forcing in forcing_table:
+                coords = self.advance(coords, forcing)
+
+        self.system_state.coords = self.detach_coords(coords)
+        self.system_state.step += integration_steps
 
     def integrate_one_step(self):
         """
@@ -111,13 +170,269 @@ class Simulator:
         :return: None
         """
 
-        self.system_state.coords = self.int_method(
+        self.system_state.coords = self.detach_coords(self.advance(
             self.system_state.coords,
-            self.forcing(self.system_state.time),
-            self.system,
-            self.increment
+            self.forcing(self.system_state.time)
+        ))
+        self.system_state.step += 1
+
+    def advance(self, coords, forcing):
+        """
+        Apply one step of **int_method** to **coords**. In-place integration methods write into a coordinates
+        buffer and stage buffers owned by the simulator, so that the caller's initial coordinates are never modified
+        and the integration method can be shared between simulators. The coordinates buffer is overwritten by the
+        next step: pass the result through detach_coords before storing it in system_state.
+        :param coords: coordinates at time t0
+        :param forcing: forcing term
+        :return: coordinates at time t0 + increment
+        """
+        if not self.int_method.in_place:
+            return self.int_method(coords, forcing, self.system, self.increment)
+
+        if coords is not self._coords_buffer:
+            if self._coords_buffer is None or self._coords_buffer.shape != np.shape(coords):
+                self._coords_buffer = np.empty(np.shape(coords))
+                self._stage_buffers = self.int_method.stage_buffers(self._coords_buffer)
+            self._coords_buffer[...] = coords
+
+        return self.int_method(
+            self._coords_buffer, forcing, self.system, self.increment,
+            out=self._coords_buffer, stages=self._stage_buffers
         )
-        self.system_state.time = round(self.system_state.time + self.increment, 2)
+
+    def detach_coords(self, coords):
+        """
+        Coordinates returned by advance, as they can be stored in system_state: a copy of the coordinates buffer
+        of in-place integration methods (which later steps overwrite), **coords** itself otherwise.
+        """
+        if coords is self._coords_buffer:
+            return coords.copy()
+        return coords
+
+    def forcing_table(self, steps: int, start: int = 0):
+        """
+        Evaluate the forcing at **steps** time steps, without evolving the system.
+        :param steps: number of integration steps
+        :param start: first step, counted from the current step
+        :return: forcing values
+        """
+        system_state = self.system_state
+        first = system_state.step + start
+        times = system_state.time_origin + step_time(np.arange(first, first + steps), self.increment)
+
+        return self.forcing.evaluate(times)
+
+    def forcing_chunks(self, steps: int, chunk_steps: int = None):
+        """
+        Evaluate the forcing at the next **steps** time steps in tables of at most **chunk_steps** steps, so that
+        memory does not grow with the length of the integration.
+        :param steps: number of integration steps
+        :param chunk_steps: maximum number of steps per table. If None, engines.FORCING_CHUNK_STEPS.
+        :return: iterator of (offset of the first step of the table, forcing values)
+        """
+        chunk_steps = engines.FORCING_CHUNK_STEPS if chunk_steps is None else chunk_steps
+        step = self.system_state.step
+        for start in range(0, steps, chunk_steps):
+            # from the step at the time of the call, whether or not the system was evolved meanwhile
+            yield start, self.forcing_table(min(chunk_steps, steps - start), step + start - self.system_state.step)
+
+    def integrate_sampled(
+            self,
+            steps: int,
+            samplers: T.Sequence[T.Tuple[np.ndarray, int]] = (),
+            first_step: int = 0,
+    ):
+        """
+        Evolve the state of system_state by **steps** integration steps, recording the states into preallocated
+        buffers (see engines.PythonEngine). Uses **engine** if set, else the Python step loop.
+        :param steps: number of integration steps
+        :param samplers: sequence of (buffer, every) pairs
+        :param first_step: index of the current step
+        :return: None
+        """
+        engine = self.engine if self.engine is not None else engines.PythonEngine()
+        engine(self, steps, samplers, first_step)
+
+
+class EnsembleSimulator(Simulator):
+    """
+    Integrate an ensemble of initial conditions at once. Coordinates of system_state are stored as a
+    (members x nodes) array, so that **system** and **int_method** advance all members in a single call per stage.
+    """
+
+    def __init__(
+            self,
+            system=systems.Lorenz96(),
+            int_method=integrators.RungeKutta4(),
+            system_state: SystemState = None,
+            increment: float = 0.01,
+            forcing=forcings.ConstantForcing(),
+            engine=None,
+    ):
+        """
+        :param system: first-order differential equations system (must operate along the last axis)
+        :param int_method: integration method
+        :param: system_state: instance of SystemState class, whose coords are (members x nodes)
+        :param: increment: time increment (dt)
+        :param: forcing: external forcing, shared by all members (or a forcings.MemberForcing, one per member)
+        :param: engine: integration engine (from lab.simulation.engines)
+        """
+        if system_state is None:
+            raise ValueError('EnsembleSimulator requires a system_state with (members x nodes) coordinates')
+
+        system_state.coords = np.array(system_state.coords, dtype=np.float64, ndmin=2)
+
+        super().__init__(
+            system=system,
+            int_method=int_method,
+            system_state=system_state,
+            increment=increment,
+            forcing=forcing,
+            engine=engine,
+        )
+
+    @classmethod
+    def from_states(
+            cls,
+            system_states: T.Sequence[SystemState],
+            **kwargs
+    ):
+        """
+        Build an ensemble stacking the coordinates of **system_states**, which must share the same time.
+        :param system_states: sequence of SystemState instances, one per member
+        :param kwargs: passed to EnsembleSimulator
+        :return: EnsembleSimulator instance
+        """
+        times = {system_state.time for system_state in system_states}
+        if len(times) != 1:
+            raise ValueError('all members of an ensemble must share the same time, got {}'.format(sorted(times)))
+
+        system_state = SystemState(
+            coords=np.stack([np.asarray(system_state.coords, dtype=np.float64) for system_state in system_states]),
+            time=times.pop()
+        )
+
+        return cls(system_state=system_state, **kwargs)
+
+    @property
+    def members(self):
+        return self.system_state.coords.shape[0]
+
+    def member_state(self, member: int) -> SystemState:
+        """
+        Return a copy of the state of a single member.
+        :param member: index of the member
+        :return: SystemState instance
+        """
+        return SystemState(
+            coords=self.system_state.coords[member].copy(),
+            time=self.system_state.time_origin,
+            step=self.system_state.step,
+            increment=self.system_state.increment,
+        )
+
+
+class PairedSimulator(EnsembleSimulator):
+    """
+    Integrate forced and control (unforced) trajectories from the same initial conditions together, as one batched
+    ensemble: for **pairs** initial conditions, members 0..pairs-1 are forced by **forcing** and members
+    pairs..2*pairs-1 by **control_forcing**, member i and i + pairs starting from the same coordinates. Responses
+    (forced - control) can then be computed in memory, e.g. with observers.ResponseAccumulator.
+    """
+
+    def __init__(
+            self,
+            system=systems.Lorenz96(),
+            int_method=integrators.RungeKutta4(),
+            system_state: SystemState = None,
+            increment: float = 0.01,
+            forcing=forcings.ConstantForcing(),
+            control_forcing=forcings.ConstantForcing(8.0),
+            engine=None,
+    ):
+        """
+        :param system: first-order differential equations system (must operate along the last axis)
+        :param int_method: integration method
+        :param: system_state: instance of SystemState class, whose coords are the (pairs x nodes) initial conditions
+        :param: increment: time increment (dt)
+        :param: forcing: forcing of the forced members
+        :param: control_forcing: forcing of the control members
+        :param: engine: integration engine (from lab.simulation.engines)
+        """
+        if system_state is None:
+            raise ValueError('a PairedSimulator needs the initial conditions')
+
+        coords = np.atleast_2d(np.asarray(system_state.coords, dtype=np.float64))
+        pairs = coords.shape[0]
+
+        super().__init__(
+            system=system,
+            int_method=int_method,
+            system_state=SystemState(
+                coords=np.concatenate([coords, coords]),
+                time=system_state.time_origin,
+                step=system_state.step,
+                increment=system_state.increment,
+            ),
+            increment=increment,
+            forcing=forcings.MemberForcing([forcing, control_forcing], [0] * pairs + [1] * pairs),
+            engine=engine,
+        )
+
+        self.forced_forcing = forcing
+        self.control_forcing = control_forcing
+
+    @property
+    def pairs(self):
+        return self.members // 2
+
+
+class _BackgroundWriter:
+    """
+    Run write calls in a separate thread, fed through a bounded queue. An error raised by a write call is stored
+    and raised again by check() or close(); later write calls are discarded.
+    """
+
+    def __init__(self, maxsize: int = 1):
+        self.error = None
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = threading.Thread(target=self._work, name='SimulationRunnerWriter', daemon=True)
+        self._thread.start()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            write, args = item
+            try:
+                write(*args)
+            except BaseException as error:
+                self.error = error
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, write, *args):
+        """
+        Queue write(*args). Blocks while the queue is full.
+        """
+        self.check()
+        self._queue.put((write, args))
+
+    def close(self, raise_error: bool = True):
+        """
+        Wait for all queued writes, then raise the error of a failed write, if any.
+        :param raise_error: if False, do not raise the error of a failed write (e.g. when another error is already
+        being raised)
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if raise_error:
+            self.check()
 
 
 class SimulationRunner:
@@ -129,15 +444,30 @@ class SimulationRunner:
             chunk_length_time: int = 1000,
             write_all_every: float = 0,
             write_one_every: float = None,
+            background_write: bool = False,
+            write_queue_size: int = 1,
+            checkpoint_every: int = 0,
+            backend=None,
+            observers: T.Sequence = (),
+            write_output: bool = True,
     ):
         """
         :param simulator: Simulator() instance
         :param integration_time: total time of integration
-        :param chunk_length: integration steps after which write on netcdf and free memory.
+        :param chunk_length: integration steps after which write on output and free memory.
         :param write_all_every: if 0, never write all nodes; else, write all nodes when time is multiple of
         **write_all_every**.
         :param write_one_every: if 0, never write one node; else, write one nodee when time is multiple of
         **write_all_every**.
+        :param background_write: if True, chunks are written by a background thread while the next chunk is
+        simulated.
+        :param write_queue_size: maximum number of simulated chunks waiting to be written (with background_write).
+        :param checkpoint_every: if 0, never checkpoint; else, save a checkpoint every **checkpoint_every** chunks,
+        from which run(resume=True) continues an interrupted simulation.
+        :param backend: output backend (from lab.simulation.backends). If None, backends.NetCDFBackend().
+        :param observers: observers (from lab.simulation.observers) fed with the records of each chunk, as they are
+        simulated.
+        :param write_output: if False, records are only passed to the observers and no output is written.
         :return
         """
         self.simulator = simulator
@@ -150,173 +480,433 @@ class SimulationRunner:
         # write_all_* from time to iterations
         self.write_all_every_iter = int(self.write_all_every / self.simulator.increment)
         self.write_one_every_iter = int(self.write_one_every / self.simulator.increment)
-
-    def _create_dataset(
+        self.background_write = background_write
+        self.write_queue_size = write_queue_size
+        self.checkpoint_every = checkpoint_every
+        self.backend = backend if backend is not None else backends.NetCDFBackend()
+        self.observers = list(observers)
+        self.write_output = write_output
+
+    def _forcing(
             self,
-            outfile_name: str,
-            nodes: int,
-            custom_attrs: dict = {},
+            member: int = None,
     ):
         """
-        This method create writeable netcdf dataset
-        :param outfile_name: name of the file
-        :return:
+        Forcing of **member** of an ensemble (its own forcing with a forcings.MemberForcing), or of the simulator.
         """
-        dataset = nc.Dataset(outfile_name, 'w', format='NETCDF4_CLASSIC')
+        forcing = self.simulator.forcing
+        if member is not None and hasattr(forcing, 'member_forcing'):
+            return forcing.member_forcing(member)
+        return forcing
 
-        dataset.createDimension('node', nodes)
-        dataset.createDimension('time_step', None)
-
-        dataset.createVariable('node', np.int32, ('node',))
-        dataset.createVariable('time_step', np.int32, ('time_step',))
-
-        var = dataset.createVariable('var', np.float32, ('time_step', 'node'))
-
-        dataset.variables['node'][:] = np.arange(0, nodes)
-
-        # Attributes
-        var.system = self.simulator.system.long_name
-        var.integration_method = self.simulator.int_method.long_name
-        var.integration_step = self.simulator.increment
-        var.forcing = self.simulator.forcing.long_name
-        var.created = str(datetime.datetime.now())
-
-        for attr_key, attr_value in custom_attrs.items():
-            var.setncattr(attr_key, attr_value)
+    def _attrs(
+            self,
+            custom_attrs: dict = {},
+            member: int = None,
+    ) -> dict:
+        """
+        Attributes of the output variable.
+        :param custom_attrs: attributes to be added to the default ones
+        :param member: member of an ensemble
+        :return: attributes
+        """
+        attrs = {
+            'system': self.simulator.system.long_name,
+            'integration_method': self.simulator.int_method.long_name,
+            'integration_step': self.simulator.increment,
+            'forcing': self._forcing(member).long_name,
+            'created': str(datetime.datetime.now()),
+        }
+        attrs.update(custom_attrs)
 
-        return dataset
+        return attrs
 
     def _create_outfile_name(
             self,
-            custom_suffix: str = '00000'
+            custom_suffix: str = '00000',
+            member: int = None,
     ) -> dict:
 
         outfile_name_base = \
             'sim/{system}/{integrator}/{forcing}/sim_{system}_{integrator}_{forcing}'.format(
                 system=self.simulator.system.short_name,
                 integrator=self.simulator.int_method.short_name,
-                forcing=self.simulator.forcing.short_name
+                forcing=self._forcing(member).short_name
             )
 
         outfile_name = {}
 
         if self.write_one_every_iter:
-            outfile_name_one = f'{outfile_name_base}_tbr{self.write_one_every}_one_{custom_suffix}.nc'
+            outfile_name_one = f'{outfile_name_base}_tbr{self.write_one_every}_one_{custom_suffix}' \
+                               f'{self.backend.extension}'
             outfile_name['one'] = outfile_name_one
         if self.write_all_every_iter:
-            outfile_name_all = f'{outfile_name_base}_tbr{self.write_all_every}_all_{custom_suffix}.nc'
+            outfile_name_all = f'{outfile_name_base}_tbr{self.write_all_every}_all_{custom_suffix}' \
+                               f'{self.backend.extension}'
             outfile_name['all'] = outfile_name_all
 
         return outfile_name
 
-    def _init_netcdf(
+    def outfile_paths(
             self,
-            outfile_names: dict,
-            custom_attrs: dict = {},
+            data_base_path: str = DATA_BASE_PATH,
+            custom_suffix: str = '00000',
+            member: int = None,
     ) -> dict:
         """
-        Initialize netcdf to write output.
-        :return:
+        Full paths of the files written by run() for **custom_suffix**.
+        :param data_base_path: base path were data are going to be saved
+        :param custom_suffix: suffix to the out file name
+        :param member: member of an ensemble (files are named after its own forcing)
+        :return: dict of paths, keyed by output ('one', 'all')
         """
+        outfiles = self._create_outfile_name(custom_suffix, member)
 
-        datasets = {}
+        return {key: os.path.join(data_base_path, outfile) for key, outfile in outfiles.items()}
 
+    def _output_intervals(self) -> dict:
+        """
+        Sampling interval (in iterations) of each output.
+        :return: dict of intervals, keyed by output ('one', 'all')
+        """
+        intervals = {}
         if self.write_one_every_iter:
-            dataset_one = self._create_dataset(outfile_names['one'], 1, custom_attrs)
-            datasets['one'] = dataset_one
+            intervals['one'] = self.write_one_every_iter
         if self.write_all_every_iter:
-            dim = len(self.simulator.system_state.coords)
-            dataset_all = self._create_dataset(outfile_names['all'], dim, custom_attrs)
-            datasets['all'] = dataset_all
+            intervals['all'] = self.write_all_every_iter
+
+        return intervals
+
+    def _outputs(self) -> dict:
+        """
+        Sampling interval (in iterations) and number of recorded nodes of each output.
+        :return: dict of (every_iter, nodes) tuples, keyed by output ('one', 'all')
+        """
+        nodes = {'one': 1, 'all': np.shape(self.simulator.system_state.coords)[-1]}
+
+        return {key: (every, nodes[key]) for key, every in self._output_intervals().items()}
+
+    def _integration_chunks(self) -> list:
+        """
+        Split the integration into chunks.
+        :return: list of (first_step, steps) tuples
+        """
+        integration_steps = int(self.integration_time / self.simulator.increment)
+        chunks = max(int(integration_steps / self.chunk_length), 1)
+        steps = min(self.chunk_length, integration_steps)
+
+        return [(chunk * self.chunk_length, steps) for chunk in range(0, chunks)]
+
+    def expected_records(self) -> dict:
+        """
+        Number of time steps written by run() in each output.
+        :return: dict of record counts, keyed by output ('one', 'all')
+        """
+        first_step, steps = self._integration_chunks()[-1]
+        total_steps = first_step + steps
 
-        return datasets
+        return {key: -(-total_steps // every) for key, every in self._output_intervals().items()}
+
+    def _init_outputs(
+            self,
+            outfile_names: dict,
+            custom_attrs: dict = {},
+            resume: bool = False,
+            member: int = None,
+    ) -> dict:
+        """
+        Initialize the outputs through the backend.
+        :param outfile_names: paths of the outputs, keyed by output ('one', 'all')
+        :param custom_attrs: attributes to be added to the outputs
+        :param resume: if True, open the existing outputs to append to them
+        :param member: member of an ensemble
+        :return: dict of outputs
+        """
+        if resume:
+            return {key: self.backend.open(outfile_names[key]) for key in self._output_intervals()}
+
+        records = self.expected_records()
+        attrs = self._attrs(custom_attrs, member)
+
+        return {
+            key: self.backend.create(outfile_names[key], nodes, records[key], attrs)
+            for key, (_, nodes) in self._outputs().items()
+        }
+
+    @staticmethod
+    def checkpoint_path(outfiles: dict) -> str:
+        """
+        Path of the checkpoint of a run writing **outfiles** (the out files of its first member).
+        """
+        return os.path.splitext(sorted(outfiles.values())[0])[0] + '.ckpt.npz'
+
+    def _checkpoint(
+            self,
+            next_step: int,
+    ) -> dict:
+        """
+        Snapshot of everything needed to continue the simulation from **next_step**.
+        """
+        checkpoint = {
+            'coords': np.array(self.simulator.system_state.coords, dtype=np.float64),
+            'time_origin': self.simulator.system_state.time_origin,
+            'step': self.simulator.system_state.step,
+            'next_step': next_step,
+            'increment': self.simulator.increment,
+            'forcing': self.simulator.forcing.short_name,
+            'forcing_parameters': json.dumps(self.simulator.forcing.parameters(), sort_keys=True),
+        }
+
+        return checkpoint
+
+    @staticmethod
+    def _write_checkpoint(
+            path: str,
+            outputs_members: list,
+            checkpoint: dict,
+    ):
+        """
+        Flush the outputs, then atomically replace the checkpoint at **path**.
+        """
+        for outputs in outputs_members:
+            for output in outputs.values():
+                output.sync()
+
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **checkpoint)
+        os.replace(path + '.tmp', path)
+
+    def _load_checkpoint(
+            self,
+            path: str,
+    ) -> dict:
+        """
+        Load the checkpoint at **path**, checking that it belongs to a run with the same settings.
+        :return: checkpoint, or None if there is none
+        """
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as data:
+            checkpoint = {key: data[key] for key in data.files}
+
+        expected = self._checkpoint(int(checkpoint['next_step']))
+        for key in ('increment', 'forcing', 'forcing_parameters'):
+            if checkpoint.get(key) != expected[key]:
+                raise ValueError('checkpoint {} has {}={}, expected {}'.format(
+                    path, key, checkpoint.get(key), expected[key]
+                ))
+        if checkpoint['coords'].shape != expected['coords'].shape:
+            raise ValueError('checkpoint {} has coordinates of shape {}, expected {}'.format(
+                path, checkpoint['coords'].shape, expected['coords'].shape
+            ))
+
+        return checkpoint
+
+    def _chunk_buffers(
+            self,
+            first_step: int,
+            steps: int,
+    ) -> dict:
+        """
+        Allocate the buffers receiving the records of each output for the chunk of **steps** steps starting at
+        **first_step**. Only steps that are written are recorded, as float32 (the precision of the output), or
+        float64 if an observer of the output needs it (see observers.Observer.dtype).
+        :return: dict of (start, every_iter, buffer) tuples keyed by output, where start is the index of the first
+        record of the chunk and buffer is (records x [members x] nodes)
+        """
+        shape = np.shape(self.simulator.system_state.coords)
+        buffers = {}
+        for key, (every, nodes) in self._outputs().items():
+            start = -(-first_step // every)
+            records = -(-(first_step + steps) // every) - start
+            dtype = np.result_type(np.float32, *[
+                getattr(observer, 'dtype', np.float32) for observer in self.observers if observer.output == key
+            ])
+            buffers[key] = (start, every, np.empty((records,) + shape[:-1] + (nodes,), dtype=dtype))
+
+        return buffers
+
+    def _write_records(
+            self,
+            outputs_members: list,
+            buffers: dict,
+    ):
+        """
+        Write the records of one simulated chunk to the outputs of every member.
+        :param outputs_members: outputs of each member, as returned by _init_outputs
+        :param buffers: records of the chunk, as returned by _chunk_buffers
+        :return: None
+        """
+        for key, (start, every, buffer) in buffers.items():
+            time_steps = np.arange(start, start + len(buffer)) * every
+            for member, outputs in enumerate(outputs_members):
+                outputs[key].write(start, time_steps, buffer if buffer.ndim == 2 else buffer[:, member])
+
+    def _process_records(
+            self,
+            outputs_members: list,
+            buffers: dict,
+    ):
+        """
+        Write the records of one simulated chunk (see _write_records) and pass them to the observers.
+        """
+        self._write_records(outputs_members, buffers)
+
+        for observer in self.observers:
+            start, every, buffer = buffers[observer.output]
+            observer(start, np.arange(start, start + len(buffer)) * every, buffer)
 
     def run(
             self,
             data_base_path: str = DATA_BASE_PATH,
-            custom_suffix: str = '00000',
-            custom_attrs: dict = {},
+            custom_suffix: T.Union[str, T.Sequence[str]] = '00000',
+            custom_attrs: T.Union[dict, T.Sequence[dict]] = {},
+            resume: bool = False,
     ):
         """
-        Run the simulation and write the output to a netcdf file.
+        Run the simulation and write the output through the backend (netcdf files by default).
         The two functions are blend together because I make use of the ability to write while running (writing every
         N iterations). Maybe it would be better to split the functions in different methods.
+        If the simulator is an EnsembleSimulator, one set of files is written for each member, named after the forcing
+        of the member: **custom_suffix** must then be a sequence with one suffix per member (unless write_output is
+        False), and **custom_attrs** can be a sequence of per-member attributes.
+        With background_write, errors raised while writing are raised here once the simulation stops.
+        Observers see the records of each chunk right after it is simulated (in the writer thread, with
+        background_write); with write_output=False nothing is written, and only the observers collect results.
         :param data_base_path: base path were data are going to be saved
         :param custom_suffix: suffix to the out file name
-        :param custom_attrs: attributes to be added to the netcdf
-        :return:
+        :param custom_attrs: attributes to be added to the output
+        :param resume: if True and a checkpoint exists, restore the simulator from it and continue appending to the
+        existing files; otherwise start from scratch
+        :return: out file names (a list of them, one per member, for ensembles); empty if write_output is False
         """
+        for observer in self.observers:
+            if observer.output not in self._output_intervals():
+                raise ValueError('observed output {} is not recorded'.format(observer.output))
+        if not self.write_output and not self.observers:
+            raise ValueError('nothing to do: no output written and no observers')
 
         if self.write_one_every is None:
             self.write_one_every = self.simulator.increment
 
-        integration_steps = int(self.integration_time / self.simulator.increment)
-        chunks = max(int(integration_steps / self.chunk_length), 1)
-
-        outfiles = self._create_outfile_name(custom_suffix)
-        outfiles = {key: os.path.join(data_base_path, outfile) for key, outfile in outfiles.items()}
-
-        # check if dir exists. if not, create it.
-        # else remove out file if already exists
-        for outfile in outfiles.values():
-            if not os.path.exists(os.path.dirname(outfile)):
-                os.makedirs(os.path.dirname(outfile))
-            elif os.path.exists(outfile):
-                os.remove(outfile)
-
-        datasets = self._init_netcdf(
-            outfile_names=outfiles,
-            custom_attrs=custom_attrs
-        )
+        members = getattr(self.simulator, 'members', None)
+        if members is None:
+            member_indices = [None]
+            custom_suffixes = [custom_suffix]
+            custom_attrs_members = [custom_attrs]
+        else:
+            member_indices = list(range(members))
+            if not self.write_output:
+                # nothing is written: suffixes and attributes are not needed
+                custom_suffixes = ['{:06}'.format(member) for member in member_indices]
+                custom_attrs_members = [{}] * members
+            else:
+                custom_suffixes = list(custom_suffix)
+                if len(custom_suffixes) != members:
+                    raise ValueError('{} suffixes given for {} members'.format(len(custom_suffixes), members))
+                if isinstance(custom_attrs, dict):
+                    custom_attrs_members = [custom_attrs] * members
+                else:
+                    custom_attrs_members = list(custom_attrs)
+
+        outfiles_members = [
+            self.outfile_paths(data_base_path, suffix, member)
+            for member, suffix in zip(member_indices, custom_suffixes)
+        ]
+        checkpoint_path = self.checkpoint_path(outfiles_members[0])
+
+        checkpoint = self._load_checkpoint(checkpoint_path) if resume else None
+        if checkpoint is not None:
+            if self.observers:
+                raise ValueError('the state of observers is not checkpointed: cannot resume from {}'.format(
+                    checkpoint_path
+                ))
+            self.simulator.system_state.coords = checkpoint['coords']
+            self.simulator.system_state.time = checkpoint['time_origin'].item()
+            self.simulator.system_state.step = int(checkpoint['step'])
+        elif os.path.exists(checkpoint_path):
+            # the outputs are recreated: a later resume must not continue them from the checkpoint of another run
+            os.remove(checkpoint_path)
+
+        outputs_members = []
+
+        for member, outfiles, attrs in zip(member_indices, outfiles_members, custom_attrs_members):
+
+            if not self.write_output:
+                continue
+
+            # check if dir exists. if not, create it.
+            for outfile in outfiles.values():
+                if not os.path.exists(os.path.dirname(outfile)):
+                    os.makedirs(os.path.dirname(outfile))
+
+            outputs = self._init_outputs(
+                outfile_names=outfiles,
+                custom_attrs=attrs,
+                resume=checkpoint is not None,
+                member=member,
+            )
 
-        count = 0
-
-        for chunk in np.arange(0, chunks):
-            dim = len(self.simulator.system_state.coords)
-            t = []
-            data_array = np.empty((min(self.chunk_length, integration_steps), dim))
-            # simulate one chunk
-            for i in np.arange(0, min(self.chunk_length, integration_steps)):
-                data_array[i, :] = self.simulator.system_state.coords
-                t.append(i+chunk*self.chunk_length)
-                self.simulator.integrate_one_step()
-                count += 1
-            # write on file
-            if self.write_one_every_iter:
-                if self.chunk_length >= self.write_one_every_iter:
-                    indices = [
-                        i for i in range(0, min(self.chunk_length, integration_steps), self.write_one_every_iter)
-                    ]
-                    data_array_one = data_array[indices, 0]
-                    t_one = [t[i] for i in indices]
-                    datasets['one'].variables['var'][(len(indices) * chunk):(len(indices) * (chunk + 1)), :] = \
-                        data_array_one
-                    datasets['one'].variables['time_step'][(len(indices) * chunk):(len(indices) * (chunk + 1))] = t_one
-                elif count >= self.write_one_every_iter:
-                    index = self.write_one_every_iter - chunk * self.chunk_length
-                    data_array_one = data_array[index, 0]
-                    t_one = t[index]
-                    datasets['one'].variables['var'][index] = data_array_one
-                    datasets['one'].variables['time_step'][index] = t_one
-            if self.write_all_every_iter:
-                if self.chunk_length >= self.write_all_every_iter:
-                    indices = [
-                        i for i in range(0, min(self.chunk_length, integration_steps), self.write_all_every_iter)
-                    ]
-                    data_array_all = data_array[indices, :]
-                    t_all = [t[i] for i in indices]
-                    datasets['all'].variables['var'][(len(indices) * chunk):(len(indices) * (chunk + 1)), :] = \
-                        data_array_all
-                    datasets['all'].variables['time_step'][(len(indices) * chunk):(len(indices) * (chunk + 1))] = t_all
-                elif count >= self.write_all_every_iter:
-                    index = self.write_all_every_iter - chunk * self.chunk_length
-                    data_array_all = data_array[index, 0]
-                    t_all = t[index]
-                    datasets['one'].variables['var'][index] = data_array_all
-                    datasets['one'].variables['time_step'][index] = t_all
-
-        if datasets:
-            for dataset in datasets.values():
-                dataset.close()
-
-        return outfiles
+            outputs_members.append(outputs)
+
+        start_step = 0 if checkpoint is None else int(checkpoint['next_step'])
+        chunks = [(first_step, steps) for first_step, steps in self._integration_chunks() if first_step >= start_step]
+
+        writer = _BackgroundWriter(self.write_queue_size) if self.background_write else None
+
+        for observer in self.observers:
+            observer.start(self)
+
+        failed = False
+        try:
+            for chunk, (first_step, steps) in enumerate(chunks, start=1):
+                buffers = self._chunk_buffers(first_step, steps)
+                # simulate one chunk
+                self.simulator.integrate_sampled(
+                    steps,
+                    [(buffer, every) for _, every, buffer in buffers.values()],
+                    first_step=first_step
+                )
+                # write on file and observe
+                if writer is None:
+                    self._process_records(outputs_members, buffers)
+                else:
+                    writer.submit(self._process_records, outputs_members, buffers)
+                # save checkpoint, once the chunk is written (observers, the only results without output, cannot
+                # resume)
+                if self.write_output and self.checkpoint_every and chunk % self.checkpoint_every == 0 \
+                        and chunk < len(chunks):
+                    checkpoint = self._checkpoint(first_step + steps)
+                    if not os.path.exists(os.path.dirname(checkpoint_path)):
+                        os.makedirs(os.path.dirname(checkpoint_path))
+                    if writer is None:
+                        self._write_checkpoint(checkpoint_path, outputs_members, checkpoint)
+                    else:
+                        writer.submit(self._write_checkpoint, checkpoint_path, outputs_members, checkpoint)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            try:
+                if writer is not None:
+                    # an error of the integration is not replaced by that of a write
+                    writer.close(raise_error=not failed)
+            finally:
+                for outputs in outputs_members:
+                    for output in outputs.values():
+                        output.close()
+
+        for observer in self.observers:
+            observer.close()
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        if not self.write_output:
+            outfiles_members = [{} for _ in outfiles_members]
+
+        if members is None:
+            return outfiles_members[0]
+
+        return outfiles_members
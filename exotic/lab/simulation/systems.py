@@ -29,18 +29,68 @@ class Lorenz96(System):
     def long_name(self):
         return 'Lorenz 96'
 
-    def __call__(self, x, forcing):
+    def __call__(self, x, forcing, out=None):
+        """
+        This method implement Lorenz-96 first-order differential equations system, vectorized over nodes.
+        Nodes are taken along the last axis of **x**.
+        :param x: coordinates at time t0
+        :param forcing: (constant) forcing term
+        :param out: if given, array (not overlapping **x**) where derivatives are written without temporaries
+        :return: state derivatives at time t0
+        """
+        if out is not None:
+            return self._call_out(np.asarray(x), forcing, out)
+
+        x = np.asarray(x, dtype=np.float64)
+
+        d = (np.roll(x, -1, axis=-1) - np.roll(x, 2, axis=-1)) * np.roll(x, 1, axis=-1) - x + forcing
+
+        return d
+
+    @staticmethod
+    def _call_out(x, forcing, out):
+        """
+        Same as __call__, writing into **out** through slices of **x** instead of rolled copies.
+        """
+        n = x.shape[-1]
+        if n < 3:
+            raise ValueError('Lorenz-96 requires at least 3 nodes, got {}'.format(n))
+
+        # nodes 2..n-2: (x[i+1] - x[i-2]) * x[i-1]
+        np.subtract(x[..., 3:], x[..., :-3], out=out[..., 2:-1])
+        np.multiply(out[..., 2:-1], x[..., 1:-2], out=out[..., 2:-1])
+        # nodes 0, 1 and n-1 wrap around
+        np.subtract(x[..., 1:2], x[..., n-2:n-1], out=out[..., 0:1])
+        np.multiply(out[..., 0:1], x[..., n-1:n], out=out[..., 0:1])
+        np.subtract(x[..., 2:3], x[..., n-1:n], out=out[..., 1:2])
+        np.multiply(out[..., 1:2], x[..., 0:1], out=out[..., 1:2])
+        np.subtract(x[..., 0:1], x[..., n-3:n-2], out=out[..., n-1:n])
+        np.multiply(out[..., n-1:n], x[..., n-2:n-1], out=out[..., n-1:n])
+
+        np.subtract(out, x, out=out)
+        np.add(out, forcing, out=out)
+
+        return out
+
+
+class Lorenz96Loop(Lorenz96):
+    """
+    Reference implementation of Lorenz-96, looping over nodes. Kept for testing the vectorized version.
+    """
+
+    def __call__(self, x, forcing, out=None):
         """
         This method implement Lorenz-96 first-order differential equations system.
         :param x: coordinates at time t0
         :param forcing: (constant) forcing term
+        :param out: if given, array where derivatives are written
         :return: state derivatives at time t0
         """
         n = len(x)
 
-        d = np.zeros(n)
+        d = np.zeros(n) if out is None else out
 
         for i in range(0, n):
             d[i] = (x[(i + 1) % n] - x[i - 2]) * x[i - 1] - x[i] + forcing
 
-        return d
\ No newline at end of file
+        return d
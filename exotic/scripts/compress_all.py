@@ -1,32 +1,175 @@
+import concurrent.futures
+import hashlib
 import os
+import shutil
 import subprocess
+import tarfile
+import time
 
 import click
 
 
 FNULL = open(os.devnull, 'w')
 
+# codec: (compressor command, given the number of threads and the level, archive extension)
+CODECS = {
+    'zstd': (lambda threads, level: ['zstd', '-T{}'.format(threads), '-{}'.format(level)], '.tar.zst'),
+    'xz': (lambda threads, level: ['xz', '-T{}'.format(threads), '-{}'.format(level)], '.tar.xz'),
+    'gzip': (lambda threads, level: ['gzip', '-{}'.format(level)], '.tar.gz'),
+}
+DEFAULT_LEVELS = {'zstd': 3, 'xz': 1, 'gzip': 6}
+
+
+def pick_codec(codec):
+    """
+    Return **codec**, or with 'auto' the fastest codec available (zstd, then xz, then gzip).
+    """
+    if codec != 'auto':
+        if shutil.which(codec) is None:
+            raise click.ClickException('{} is not installed'.format(codec))
+        return codec
+
+    for name in ('zstd', 'xz', 'gzip'):
+        if shutil.which(name) is not None:
+            return name
+
+    raise click.ClickException('no compressor found')
+
+
+def count_entries(path):
+    """
+    Number of entries (the directory itself, its sub-directories and files) that tar archives for **path**.
+    """
+    entries = 1
+    for _, dirs, files in os.walk(path):
+        entries += len(dirs) + len(files)
+
+    return entries
+
+
+def dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files
+    )
+
+
+def digest(f):
+    """
+    SHA-256 of the file object **f**, read in blocks.
+    """
+    sha256 = hashlib.sha256()
+    for block in iter(lambda: f.read(2 ** 20), b''):
+        sha256.update(block)
+
+    return sha256.hexdigest()
+
+
+def verify(archive_full_path, parent_dir, dir_to_compress, codec):
+    """
+    Decompress the whole archive (which checks the integrity of the compressed stream) and compare each archived
+    file, by size and checksum, with the file on disk.
+    :raise RuntimeError: if the archive does not match the directory
+    """
+    decompress = subprocess.Popen([codec, '-dc', archive_full_path], stdout=subprocess.PIPE, stderr=FNULL)
+    entries = 0
+    try:
+        with tarfile.open(fileobj=decompress.stdout, mode='r|') as tar:
+            for member in tar:
+                entries += 1
+                if not member.isfile():
+                    continue
+                path = os.path.join(parent_dir, member.name)
+                if member.size != os.path.getsize(path):
+                    raise RuntimeError('{} has size {} in {}, {} on disk'.format(
+                        member.name, member.size, archive_full_path, os.path.getsize(path)
+                    ))
+                with open(path, 'rb') as f:
+                    if digest(tar.extractfile(member)) != digest(f):
+                        raise RuntimeError('{} differs in {}'.format(member.name, archive_full_path))
+    finally:
+        decompress.stdout.close()
+        returncode = decompress.wait()
+
+    if returncode != 0:
+        raise RuntimeError('{} -dc {} failed with code {}'.format(codec, archive_full_path, returncode))
+
+    expected = count_entries(os.path.join(parent_dir, dir_to_compress))
+    if entries != expected:
+        raise RuntimeError('{} lists {} entries, expected {}'.format(archive_full_path, entries, expected))
+
+
+def compress(parent_dir, dir_to_compress, codec, threads, level, keep):
+    """
+    Archive and compress **dir_to_compress**, verify the archive, then remove the directory (unless **keep**).
+    :return: (archive path, size of the directory in bytes, size of the archive in bytes, seconds)
+    """
+    dir_to_compress_full_path = os.path.join(parent_dir, dir_to_compress)
+    compressor, extension = CODECS[codec]
+    archive_full_path = os.path.join(parent_dir, dir_to_compress + extension)
+    use_compress_program = '--use-compress-program={}'.format(' '.join(compressor(threads, level)))
+
+    start = time.perf_counter()
+    size = dir_size(dir_to_compress_full_path)
+    subprocess.run(
+        ['tar', use_compress_program, '-cf', archive_full_path, '-C', parent_dir, dir_to_compress],
+        check=True, stdout=FNULL, stderr=subprocess.STDOUT,
+    )
+    verify(archive_full_path, parent_dir, dir_to_compress, codec)
+    seconds = time.perf_counter() - start
+
+    if not keep:
+        shutil.rmtree(dir_to_compress_full_path)
+
+    return archive_full_path, size, os.path.getsize(archive_full_path), seconds
+
 
 @click.command()
 @click.argument('parent_dir')
-def main(parent_dir):
+@click.option('--jobs', default=2, show_default=True, help='Directories compressed concurrently.')
+@click.option('--threads', type=int, default=None,
+              help='Compression threads per directory (zstd and xz). Default: the cores shared between the jobs.')
+@click.option('--codec', type=click.Choice(['auto'] + list(CODECS)), default='auto', show_default=True,
+              help='Compressor, auto for the fastest available.')
+@click.option('--level', type=int, default=None, help='Compression level (default depends on the codec).')
+@click.option('--keep', is_flag=True, help='Keep the directories after compression.')
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+def main(parent_dir, jobs, threads, codec, level, keep, yes):
     dirs_to_compress = [
         sub_dir for sub_dir in os.listdir(parent_dir) if os.path.isdir(os.path.join(parent_dir, sub_dir))
     ]
-    click.echo("The following folders in {} will be compressed: {}".format(parent_dir, dirs_to_compress))
-    click.confirm('Do you want to continue?', abort=True)
+    codec = pick_codec(codec)
+    level = DEFAULT_LEVELS[codec] if level is None else level
+    # jobs * threads does not oversubscribe the cores
+    threads = max((os.cpu_count() or 1) // jobs, 1) if threads is None else threads
+
+    click.echo("The following folders in {} will be compressed with {}: {}".format(
+        parent_dir, codec, dirs_to_compress
+    ))
+    if not yes:
+        click.confirm('Do you want to continue?', abort=True)
 
-    for dir_to_compress in dirs_to_compress:
-        dir_to_compress_full_path = os.path.join(parent_dir, dir_to_compress)
-        archive_full_path = os.path.join(parent_dir, dir_to_compress + '.tar.gz')
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(compress, parent_dir, dir_to_compress, codec, threads, level, keep): dir_to_compress
+            for dir_to_compress in dirs_to_compress
+        }
+        for future in concurrent.futures.as_completed(futures):
+            dir_to_compress = futures[future]
+            try:
+                archive_full_path, size, archive_size, seconds = future.result()
+            except (subprocess.CalledProcessError, RuntimeError, OSError, tarfile.TarError) as e:
+                click.echo('Failed to compress {}: {}'.format(dir_to_compress, e), err=True)
+                failed.append(dir_to_compress)
+                continue
 
-        click.echo('Compressing {} into {}'.format(dir_to_compress_full_path, archive_full_path))
-        command_compress = 'tar -czvf {} {}'.format(archive_full_path, dir_to_compress_full_path)
-        subprocess.call(command_compress, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
+            click.echo('Compressed {} into {}: {:.1f} MB in {:.1f} s ({:.1f} MB/s, ratio {:.2f}){}'.format(
+                dir_to_compress, archive_full_path, size / 1e6, seconds, size / 1e6 / max(seconds, 1e-9),
+                size / max(archive_size, 1), '' if keep else ', removed'
+            ))
 
-        click.echo('Removing {}'.format(dir_to_compress_full_path))
-        command_remove = 'rm -rf {}'.format(dir_to_compress_full_path)
-        subprocess.call(command_remove, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
+    if failed:
+        raise click.ClickException('{} folders failed: {}'.format(len(failed), failed))
 
 
 if __name__ == "__main__":
@@ -1,13 +1,16 @@
 import sys
 import os
-import xarray as xr
 import numpy as np
+import xarray as xr
 from slack_progress import SlackProgress
 from slackclient import SlackClient
 
 sys.path.append('/home/users/tx827782/devel/phd')
 DATA_PATH = os.environ.get('BASE_DATA_PATH')
 
+from lab import quantiles as lab_quantiles
+from lab import response
+from lab.simulation import forcings
 from lab.simulation import observables
 
 OBS_DICT = {
@@ -15,6 +18,12 @@ OBS_DICT = {
    'position': observables.Position
 }
 
+# histogram range of each observable (values outside are counted, but only min/max are kept exactly)
+OBS_RANGE = {
+    'energy': (0, 250),
+    'position': (-25, 25),
+}
+
 # instantiate Slack client
 sc = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
 sp = SlackProgress(os.environ.get('SLACK_BOT_TOKEN'), '#l96lrt')
@@ -23,11 +32,29 @@ obs = sys.argv[1]
 q_start = float(sys.argv[2])
 q_stop = float(sys.argv[3])
 q_step = float(sys.argv[4])
+# members to add to the quantile table (default: 1 to 1000), so that separate runs can cover different members
+sim_first = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+sim_num = int(sys.argv[6]) if len(sys.argv) > 6 else 1000
+# 'sketch' (bounded memory, mergeable between runs), 'exact' (all values of this run in memory) or 'import' (store
+# the quantile file written before the quantile table, once, before the response jobs read the table)
+method = sys.argv[7] if len(sys.argv) > 7 else 'sketch'
 
 obs_class = OBS_DICT[obs]
 
 quantile_orders = [q for q in np.arange(q_start, q_stop, q_step)]
-sim_num = 1000
+sim_last = sim_first + sim_num - 1
+
+# same key as the scripts reading the table
+forcing = forcings.ConstantForcing(8.0).short_name
+table = lab_quantiles.QuantileTable(os.path.join(DATA_PATH, 'obs/lorenz96/rk4/quantiles'))
+
+if method == 'import':
+    table.import_dataarray(obs, forcing, xr.open_dataarray(os.path.join(
+        DATA_PATH,
+        f'obs/lorenz96/rk4/{forcing}/quantiles',
+        f'obs_lorenz96_rk4_{forcing}_quantiles_{obs}.nc')
+    ))
+    sys.exit()
 
 sc.api_call(
     "chat.postMessage",
@@ -43,8 +70,14 @@ sc.api_call(
 pbar = sp.new(total=100)
 
 counter = 0
+if method == 'exact':
+    # each file holds 10000 time steps of one node
+    sketch = lab_quantiles.ExactQuantiles(size=sim_num * 10000)
+else:
+    sketch = lab_quantiles.HistogramSketch(*OBS_RANGE[obs])
+observable = obs_class()
 
-for i in np.arange(1, sim_num + 1):
+for i in np.arange(sim_first, sim_last + 1):
 
     file_path = os.path.join(
         DATA_PATH,
@@ -52,15 +85,7 @@ for i in np.arange(1, sim_num + 1):
         'sim_lorenz96_rk4_CF_8_one_{:05}.nc'.format(i)
     )
 
-    data = xr.open_dataarray(file_path)
-    observable = obs_class()
-
-    observable_values = observable(data)
-
-    if counter == 0:
-        observable_values_arr = observable_values.values.squeeze()
-    else:
-        observable_values_arr = np.concatenate((observable_values_arr, observable_values.values.squeeze()))
+    sketch.update(observable(response.read_var(file_path)))
 
     counter += 1
 
@@ -75,44 +100,24 @@ sc.api_call(
     channel="#l96lrt",
     text="Computing quantiles"
 )
-pbar = sp.new(total=100)
-
-quantiles = []
-counter = 0
-
-for q in quantile_orders:
-
-    quantile = np.quantile(observable_values_arr, q)
-    quantiles.append(quantile)
-
-    counter += 1
-
-    try:
-        pbar.pos = round(counter / (len(quantile_orders)) * 100)
-    except:
-        pass
 
-quantiles_dataarray = xr.DataArray(quantiles, coords=[quantile_orders], dims=['quantile_order'])
+if method == 'exact':
+    table.set_values(
+        obs, forcing, quantile_orders, sketch.quantile(quantile_orders), np.arange(sim_first, sim_last + 1)
+    )
+else:
+    # the sketch of this run is merged with those of the members added by previous runs
+    table.add_members(obs, forcing, sketch, np.arange(sim_first, sim_last + 1))
+    table.add_orders(obs, forcing, quantile_orders)
 
+# all the quantiles in the table, also in the format of the old quantile files (next to them, which are left as
+# they are)
 out_path = os.path.join(
-    DATA_PATH,
-    'obs/lorenz96/rk4/CF_8/quantiles/obs_lorenz96_rk4_CF_8_quantiles_{}.nc'.format(obs)
-)
-
-out_path_new = os.path.join(
     DATA_PATH,
     'obs/lorenz96/rk4/CF_8/quantiles/obs_lorenz96_rk4_CF_8_quantiles_{}_new.nc'.format(obs)
 )
 
-
 if not os.path.exists(os.path.dirname(out_path)):
     os.makedirs(os.path.dirname(out_path))
 
-try:
-    quantiles_dataarray_old = xr.open_dataarray(out_path)
-    quantiles_dataarray_new = xr.concat([quantiles_dataarray_old, quantiles_datarray], dim='quantile_order')
-    # quantiles_dataarray_new.attrs['total_timesteps'] = sim_num * 10000
-    quantiles_dataarray_new.to_netcdf(out_path_new)
-except:
-    quantiles_dataarray.attrs['total_timesteps'] = sim_num * 10000
-    quantiles_dataarray.to_netcdf(out_path_new)
+table.to_dataarray(obs, forcing).to_netcdf(out_path)
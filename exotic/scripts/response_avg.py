@@ -8,6 +8,9 @@ from slackclient import SlackClient
 
 sys.path.append('../')
 
+from lab import response
+from lab import quantiles as lab_quantiles
+from lab.simulation import forcings
 from lab.simulation import observables
 
 dirname = os.path.dirname(__file__)
@@ -31,20 +34,16 @@ obs_stat = obs_sn.split('_')[1]
 
 if obs_stat in ('bin', 'below', 'exceed'):
 
-    threshold_q = list()
-    threshold_q.append(round(float(sys.argv[3]), 2))
-    try:
-        threshold_q.append(round(float(sys.argv[4]), 2))
-    except:
+    threshold_q = [round(float(q), 2) for q in sys.argv[3:5]]
+    if len(threshold_q) == 1:
         print('only one threshold selected')
 
-    quantiles = xr.open_dataarray(os.path.join(
-        DATA_PATH,
-        f'obs/lorenz96/rk4/CF_8.0/quantiles/obs_lorenz96_rk4_CF_8.0_quantiles_{obs_main}.nc')
-    )
-    quantiles_orders = [np.round(q, 2) for q in quantiles.quantile_order.values]
-    quantiles = quantiles.assign_coords(coords={'quantile_order': quantiles_orders})
-    threshold = [quantiles.sel(quantile_order=tq).values for tq in threshold_q]
+    # same key as compute_quantile.py
+    quantile_forcing = forcings.ConstantForcing(8.0).short_name
+    # read only: many of these jobs run at once on the same table (quantile files written before the table are
+    # imported once with compute_quantile.py)
+    table = lab_quantiles.QuantileTable(os.path.join(DATA_PATH, 'obs/lorenz96/rk4/quantiles'))
+    threshold = [table.value(obs_main, quantile_forcing, tq) for tq in threshold_q]
 
 observable_class = OBS_DICT[obs_stat]
 if obs_stat in ('bin', 'below', 'exceed'):
@@ -64,34 +63,29 @@ data_forcing_path = os.path.join(
 num_forcing_sim = len(glob.glob(f'{data_forcing_path}/*tbr0.01*'))
 
 # TODO: make tbr0.01 a user input
-counter = 0
 # NOTE: I ignore the 00000 simulation (not yet on attractor)
-for i in range(1, num_forcing_sim):
-    # compute observation forcing
-    file_name_forcing = f'sim_lorenz96_rk4_{forcing_sn}_tbr0.01_one_{i:05}.nc'
-    data_forcing = xr.open_dataarray(os.path.join(data_forcing_path, file_name_forcing))
-    obs_forcing = observable(data_forcing)
-    obs_forcing.attrs = data_forcing.attrs
-    # compute observation no forcing
-    file_name_noforcing = f'sim_lorenz96_rk4_CF_8.0_tbr0.01_one_{i:05}.nc'
-    data_noforcing = xr.open_dataarray(os.path.join(data_noforcing_path, file_name_noforcing))
-    obs_noforcing = observable(data_noforcing)
-    obs_noforcing.attrs = data_noforcing.attrs
-    # compute response
-    response = obs_forcing - obs_noforcing
-    if counter == 0:
-        response_avg = response
-    else:
-        response_avg += response  
-    counter += 1
-
-response_avg = response_avg/counter
+members = range(1, num_forcing_sim)
+forced_paths = [
+    os.path.join(data_forcing_path, f'sim_lorenz96_rk4_{forcing_sn}_tbr0.01_one_{i:05}.nc') for i in members
+]
+unforced_paths = [
+    os.path.join(data_noforcing_path, f'sim_lorenz96_rk4_CF_8.0_tbr0.01_one_{i:05}.nc') for i in members
+]
+
+estimator = response.ResponseEstimator(observable)
+estimator.update(forced_paths, unforced_paths)
+response_stats = estimator.to_dataset()
+
+response_avg = response_stats['mean'].rename('var')
 print(response_avg)
 
 response_avg.attrs['forcing'] = forcing_sn
 response_avg.attrs['observable'] = observable.short_name
 response_avg.attrs['ensemble'] = num_forcing_sim - 1
 
+response_stats.attrs['forcing'] = forcing_sn
+response_stats.attrs['ensemble'] = num_forcing_sim - 1
+
 # Save Average Response
 
 out_name = os.path.join(
@@ -104,4 +98,6 @@ if not os.path.exists(os.path.dirname(out_name)):
     os.makedirs(os.path.dirname(out_name))
 
 response_avg.to_netcdf(out_name)
+# mean, variance, count, standard error and confidence band of the response
+response_stats.to_netcdf(out_name.replace('.nc', '_stats.nc'))
 
@@ -8,6 +8,8 @@ from slackclient import SlackClient
 
 sys.path.append('../')
 
+from lab import quantiles as lab_quantiles
+from lab.simulation import forcings
 from lab.simulation import observables
 
 dirname = os.path.dirname(__file__)
@@ -31,20 +33,16 @@ obs_stat = obs_sn.split('_')[1]
 
 if obs_stat in ('bin', 'below', 'exceed'):
 
-    threshold_q = list()
-    threshold_q.append(round(float(sys.argv[3]), 2))
-    try:
-        threshold_q.append(round(float(sys.argv[4]), 2))
-    except:
+    threshold_q = [round(float(q), 2) for q in sys.argv[3:5]]
+    if len(threshold_q) == 1:
         print('only one threshold selected')
 
-    quantiles = xr.open_dataarray(os.path.join(
-        DATA_PATH,
-        f'obs/lorenz96/rk4/CF_8.0/quantiles/obs_lorenz96_rk4_CF_8.0_quantiles_{obs_main}.nc')
-    )
-    quantiles_orders = np.round(quantiles.quantile_order.values, 2)
-    quantiles.assign_coords(coords={'quantile_order': quantiles_orders})
-    threshold = [quantiles.sel(quantile_order=tq).values for tq in threshold_q]
+    # same key as compute_quantile.py
+    quantile_forcing = forcings.ConstantForcing(8.0).short_name
+    # read only: many of these jobs run at once on the same table (quantile files written before the table are
+    # imported once with compute_quantile.py)
+    table = lab_quantiles.QuantileTable(os.path.join(DATA_PATH, 'obs/lorenz96/rk4/quantiles'))
+    threshold = [table.value(obs_main, quantile_forcing, tq) for tq in threshold_q]
 
 observable_class = OBS_DICT[obs_stat]
 if obs_stat in ('bin', 'below', 'exceed'):
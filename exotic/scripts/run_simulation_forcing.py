@@ -1,17 +1,15 @@
 import sys
 import os
+import logging
 
 import yaml
-import xarray as xr
 from slackclient import SlackClient
 from slack_progress import SlackProgress
 
 sys.path.append('../')
 
-import lab.simulation.simulation as sim
 import lab.simulation.forcings as forcings
-import lab.simulation.systems as systems
-import lab.simulation.integrators as integrators
+import lab.simulation.scheduler as ensemble
 
 dirname = os.path.dirname(__file__)
 # Read configuration file
@@ -28,96 +26,71 @@ sp = SlackProgress(config['slack_bot_token'], '#l96lrt')
 
 DATA_PATH = os.path.join(dirname, '../../../../data')
 
-initial_conditions = xr.open_dataarray(os.path.join(
+logger = logging.getLogger(__name__)
+
+INITIAL_CONDITIONS_PATH = os.path.join(
     DATA_PATH,
     'sim/lorenz96/rk4/init/sim_lorenz96_rk4_CF_8.0_all_init.nc'
-))
-
-system = systems.Lorenz96()
-int_method = integrators.RungeKutta4()
-
-forcing_id = (sys.argv[1])
-
-sim_start = int(sys.argv[2])
-sim_num = int(sys.argv[3])
-time_between_init_cond = int(sys.argv[4])
-integration_time = float(sys.argv[5])
-time_between_single_records = float(sys.argv[6])
-time_between_complete_records = float(sys.argv[7])
-
-if forcing_id == 'constant':
-    force = forcings.ConstantForcing(
-        force_intensity=float(sys.argv[8])
-    )
-elif forcing_id == 'delta':
-    force = forcings.DeltaForcing(
-        activation_time=0,
-        force_intensity_base=float(sys.argv[8]),
-        force_intensity_delta=float(sys.argv[9])
-    )
-elif forcing_id == 'step':
-    force = forcings.StepForcing(
-        activation_time=0,
-        force_intensity_base=float(sys.argv[8]),
-        force_intensity_delta=float(sys.argv[9])
-    )
-elif forcing_id == 'linear':
-    force = forcings.LinearForcing(
-        activation_time=0,
-        deactivation_time=100,
-        force_intensity_base=float(sys.argv[8]),
-        linear_coefficient=float(sys.argv[9])
-    )
-elif forcing_id == 'sinusoidal':
-    force = forcings.SinusoidalForcing(
-        activation_time=0,
-        deactivation_time=100,
-        force_intensity_base=float(sys.argv[8]),
-        epsilon=float(sys.argv[9]),
-        omega=float(sys.argv[10])
-    )
-else:
-    raise ValueError('{} forcing not supported!'.format(forcing_id))
-
-sc.api_call(
-    "chat.postMessage",
-    channel="#l96lrt",
-    text="Running {} simulations with forcing {}".format(sim_num, force._short_name)
 )
 
-pbar = sp.new()
 
-for sim_index in range(sim_start, sim_start + sim_num):
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
-    time_step_real = int(sim_index*time_between_init_cond/initial_conditions.integration_step)
+    forcing_id = (sys.argv[1])
 
-    point = sim.SystemState(
-        coords=initial_conditions.sel(time_step=time_step_real).values,
-    )
+    sim_start = int(sys.argv[2])
+    sim_num = int(sys.argv[3])
+    time_between_init_cond = int(sys.argv[4])
+    integration_time = float(sys.argv[5])
+    time_between_single_records = float(sys.argv[6])
+    time_between_complete_records = float(sys.argv[7])
 
-    simulator = sim.Simulator(
-        system_state=point,
-        forcing=force,
-        int_method=int_method,
-        system=system
-    )
-
-    runner = sim.SimulationRunner(
-        simulator=simulator,
+    scheduler = ensemble.EnsembleScheduler(
+        forcing_id=forcing_id,
+        forcing_params=sys.argv[8:],
+        initial_conditions_path=INITIAL_CONDITIONS_PATH,
+        time_between_init_cond=time_between_init_cond,
         integration_time=integration_time,
-        chunk_length_time=1000,
+        write_one_every=time_between_single_records,
         write_all_every=time_between_complete_records,
-        write_one_every=time_between_single_records
-    )
-
-    outfiles = runner.run(
         data_base_path=DATA_PATH,
-        custom_suffix='{:06}'.format(sim_index),
-        custom_attrs={'time_step_0_real': time_step_real}
+        chunk_length_time=1000,
+        # whole-series chunks of the single-node output, read at once per member by response_avg*.py
+        backend_options={'chunk_time': 10000, 'zlib': True, 'complevel': 1, 'fixed_length': True},
     )
+    force = forcings.build_forcing(forcing_id, sys.argv[8:])
+
+    sc.api_call(
+        "chat.postMessage",
+        channel="#l96lrt",
+        text="Running {} simulations with forcing {} on {} workers".format(
+            sim_num, force._short_name, scheduler.max_workers
+        )
+    )
+
+    pbar = sp.new()
+    done = []
+
+    def on_member_done(sim_index, outfiles, error):
+        done.append(sim_index)
+        if error is not None:
+            logger.error('simulation %s failed', sim_index, exc_info=error)
+        try:
+            pbar.pos = round(len(done)/sim_num*100)
+        except:
+            pass
+
+    results = scheduler.run(range(sim_start, sim_start + sim_num), callback=on_member_done)
+
+    failed = [sim_index for sim_index, result in results.items() if isinstance(result, Exception)]
+    if failed:
+        sc.api_call(
+            "chat.postMessage",
+            channel="#l96lrt",
+            text="{} simulations with forcing {} failed: {}".format(len(failed), force._short_name, failed)
+        )
 
-    try:
-        pbar.pos = round((sim_index-sim_start)/sim_num*100)
-    except:
-        pass
 
+if __name__ == '__main__':
+    main()
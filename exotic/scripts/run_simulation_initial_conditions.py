@@ -32,12 +32,15 @@ runner = sim.SimulationRunner(
     integration_time=1001000,
     chunk_length_time=1000,
     write_all_every=10,
-    write_one_every=0
+    write_one_every=0,
+    checkpoint_every=1
 )
 
+# continue from the last checkpoint if a previous job was killed
 outfiles = runner.run(
     data_base_path=DATA_PATH,
-    custom_suffix='init'
+    custom_suffix='init',
+    resume=True
 )
 
 for outfile in outfiles:
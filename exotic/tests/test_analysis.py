@@ -0,0 +1,41 @@
+import numpy as np
+import xarray as xr
+from lab import analysis
+from lab.simulation import forcings
+
+
+def test_compute_responses_matches_single():
+
+    series = np.cumsum(np.random.RandomState(0).normal(size=(3, 500)), axis=1)
+    forcing_list = [
+        forcings.StepForcing(0, 8, 0.5),
+        forcings.LinearForcing(0, 100, 8, 0.01),
+        forcings.SinusoidalForcing(0, 100, 8, 1, 0.3),
+    ]
+
+    result = analysis.compute_responses(analysis.compute_susceptibilities(series), forcing_list, length=500)
+
+    assert result.shape == (3, 3, 500)
+    for i, observable_series in enumerate(series):
+        chi = analysis.compute_susceptibility(observable_series)
+        for j, forcing in enumerate(forcing_list):
+            assert np.allclose(result[i, j], analysis.compute_response(chi, forcing)[:500])
+
+
+def test_SpectraCache(tmp_path):
+
+    series = np.cumsum(np.random.RandomState(0).normal(size=(2, 300)), axis=1)
+    response_paths = []
+    for i, observable_series in enumerate(series):
+        response_paths.append(str(tmp_path / 'response_{}.nc'.format(i)))
+        xr.DataArray(observable_series[:, None], dims=('time_step', 'node')).to_netcdf(response_paths[-1])
+    forcing_list = [forcings.StepForcing(0, 8, 0.5), forcings.SinusoidalForcing(0, 100, 8, 1, 0.3)]
+    expected = analysis.compute_responses(analysis.compute_susceptibilities(series), forcing_list, length=300)
+
+    cache = analysis.SpectraCache(maxsize=2, path=str(tmp_path / 'cache'))
+    assert np.allclose(cache.responses(response_paths, forcing_list, length=300), expected)
+
+    # from disk
+    cache = analysis.SpectraCache(path=str(tmp_path / 'cache'))
+    assert np.allclose(cache.responses(response_paths, forcing_list, length=300), expected)
+    assert len(list((tmp_path / 'cache').iterdir())) == 4
@@ -0,0 +1,36 @@
+import numpy as np
+from lab import analysis
+from lab import bootstrap
+from lab.simulation import forcings
+
+
+def test_bootstrap_means():
+
+    data = np.random.RandomState(0).normal(size=(20, 30)).astype(np.float32)
+    counts = bootstrap.bootstrap_counts(20, 50, np.random.RandomState(1))
+
+    assert counts.shape == (50, 20)
+    assert (counts.sum(axis=1) == 20).all()
+
+    expected = np.stack([np.repeat(data, row, axis=0).mean(axis=0, dtype=np.float64) for row in counts])
+    assert np.allclose(bootstrap.bootstrap_means(data, counts), expected)
+
+
+def test_bootstrap_responses():
+
+    random_state = np.random.RandomState(0)
+    time = np.arange(400) * 0.01
+    store = bootstrap.MemberStore()
+    for _ in range(4):
+        store.append((1 - np.exp(-time)) + random_state.normal(0, 0.2, size=(25, 400)))
+    forcing_list = [forcings.StepForcing(0, 8, 1), forcings.SinusoidalForcing(0, 100, 8, 1, 0.3)]
+
+    result = bootstrap.bootstrap_responses(store, forcing_list, replicates=200, seed=2)
+
+    expected = analysis.compute_responses(
+        analysis.compute_susceptibilities(store.data.mean(axis=0, dtype=np.float64)), forcing_list, length=400
+    )[0]
+    assert store.members == 100
+    assert np.allclose(result['prediction'].values, expected)
+    assert (result['lower'].values <= result['upper'].values).all()
+    assert (result['std'].values[:, 1:] > 0).all()
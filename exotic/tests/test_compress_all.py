@@ -0,0 +1,74 @@
+import importlib.util
+import os
+import shutil
+
+import pytest
+from click.testing import CliRunner
+
+spec = importlib.util.spec_from_file_location(
+    'compress_all', os.path.join(os.path.dirname(__file__), '..', 'scripts', 'compress_all.py')
+)
+compress_all = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(compress_all)
+
+
+@pytest.mark.parametrize("codec", ['zstd', 'xz', 'gzip'])
+def test_compress_all(tmp_path, codec):
+
+    if shutil.which(codec) is None:
+        pytest.skip('{} is not installed'.format(codec))
+
+    for name in ('a', 'b'):
+        (tmp_path / name / 'sub').mkdir(parents=True)
+        (tmp_path / name / 'sub' / 'x.txt').write_text(name * 1000)
+        (tmp_path / name / 'y.bin').write_bytes(os.urandom(5000))
+
+    result = CliRunner().invoke(compress_all.main, [str(tmp_path), '--codec', codec, '--jobs', '2', '--yes'])
+
+    assert result.exit_code == 0, result.output
+    extension = compress_all.CODECS[codec][1]
+    assert sorted(os.listdir(str(tmp_path))) == ['a' + extension, 'b' + extension]
+    assert result.output.count('MB/s') == 2
+
+
+def test_verify(tmp_path):
+
+    codec = compress_all.pick_codec('auto')
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'a' / 'x.txt').write_text('x' * 1000)
+
+    archive, _, _, _ = compress_all.compress(str(tmp_path), 'a', codec, 1, 1, keep=True)
+    compress_all.verify(archive, str(tmp_path), 'a', codec)
+
+    # same size, other content
+    (tmp_path / 'a' / 'x.txt').write_text('y' * 1000)
+    with pytest.raises(RuntimeError):
+        compress_all.verify(archive, str(tmp_path), 'a', codec)
+
+    (tmp_path / 'a' / 'z.txt').write_text('z')
+    (tmp_path / 'a' / 'x.txt').write_text('x' * 1000)
+    with pytest.raises(RuntimeError):
+        compress_all.verify(archive, str(tmp_path), 'a', codec)
+
+
+def test_compress_all_failure(tmp_path, monkeypatch):
+
+    for name in ('a', 'b'):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'x.txt').write_text(name)
+
+    dir_size = compress_all.dir_size
+
+    def failing_dir_size(path):
+        if os.path.basename(path) == 'a':
+            raise OSError('unreadable')
+        return dir_size(path)
+
+    monkeypatch.setattr(compress_all, 'dir_size', failing_dir_size)
+    result = CliRunner().invoke(compress_all.main, [str(tmp_path), '--yes'])
+
+    # the other folder is compressed, the failed one is kept and reported
+    assert result.exit_code != 0
+    assert 'Failed to compress a' in result.output
+    assert 'Compressed b' in result.output
+    assert 'a' in os.listdir(str(tmp_path)) and 'b' not in os.listdir(str(tmp_path))
@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from lab import merge
+
+
+class Interrupt(Exception):
+    pass
+
+
+def test_RealizationMerger(tmp_path):
+
+    random_state = np.random.RandomState(0)
+    data = random_state.normal(size=(5, 50, 8)).astype(np.float32)
+    paths = []
+    for i, member in enumerate(data):
+        path = str(tmp_path / f'member_{i}.nc')
+        xr.DataArray(
+            member, dims=('time_step', 'node'), coords={'time_step': np.arange(50) * 10, 'node': np.arange(8)},
+            name='var', attrs={'forcing': 'CF_8.0'},
+        ).to_netcdf(path)
+        paths.append(path)
+
+    out_path = str(tmp_path / 'merged.nc')
+    merger = merge.RealizationMerger(paths, out_path, group_size=2, workers=2, chunk_time=20)
+
+    def interrupt(done, groups):
+        raise Interrupt
+
+    with pytest.raises(Interrupt):
+        merger.run(callback=interrupt)
+    assert os.path.exists(merger.manifest_path)
+
+    progress = []
+    merger.run(callback=lambda done, groups: progress.append((done, groups)))
+    assert progress[-1] == (3, 3)
+    assert len(progress) == 2
+    assert not os.path.exists(merger.manifest_path)
+
+    with xr.open_dataset(out_path) as merged:
+        assert merged['var'].dims == ('realization', 'time_step', 'node')
+        assert np.array_equal(merged['var'].values, data)
+        assert np.array_equal(merged['time_step'].values, np.arange(50) * 10)
+        assert merged['var'].attrs['forcing'] == 'CF_8.0'
@@ -0,0 +1,71 @@
+import pytest
+import numpy as np
+import xarray as xr
+from lab.simulation import observables
+
+
+@pytest.mark.parametrize("observable_class, threshold, expected", [
+    (observables.Bin, [2., 8.], lambda obs: (obs > 2.) & (obs <= 8.)),
+    (observables.Below, [2.], lambda obs: obs < 2.),
+    (observables.Exceed, [2.], lambda obs: obs > 2.),
+])
+@pytest.mark.parametrize("main", [observables.Energy(), observables.Position()])
+def test_threshold_observables(observable_class, threshold, expected, main):
+
+    data = np.random.RandomState(0).normal(2, 3, size=(1000, 1)).astype(np.float32)
+    observable = observable_class(threshold, [0.1, 0.9], main)
+    reference = expected(main(data)).astype(np.int8)
+
+    assert observable(data).dtype == np.int8
+    assert np.array_equal(observable(data), reference)
+    assert np.array_equal(observable(xr.DataArray(data, dims=('time_step', 'node'))).values, reference)
+
+
+def test_ObservableSet():
+
+    data = np.random.RandomState(0).normal(2, 3, size=(1000, 1)).astype(np.float32)
+    energy, position = observables.Energy(), observables.Position()
+    observable_set = observables.ObservableSet([
+        energy,
+        position,
+        observables.Exceed([2.], [0.9], energy),
+        observables.Exceed([4.], [0.95], energy),
+        observables.Below([0.], [0.1], position),
+        observables.Bin([1., 3.], [0.2, 0.5], position),
+    ])
+
+    result = observable_set(data)
+
+    assert list(result) == observable_set.short_names
+    for observable in observable_set:
+        assert np.array_equal(result[observable.short_name], observable(data))
+
+
+@pytest.mark.parametrize("observable", [
+    observables.Energy(),
+    observables.Position(),
+    observables.Exceed([2.], [0.9], observables.Energy()),
+    observables.Below([2.], [0.1], observables.Energy()),
+    observables.Bin([2., 8.], [0.1, 0.9], observables.Position()),
+])
+def test_observables_Dataset(observable):
+
+    data = np.random.RandomState(0).normal(2, 3, size=(1000, 2)).astype(np.float32)
+    dataset = xr.Dataset({'var': (('time_step', 'node'), data)}, attrs={'title': 'lorenz96'})
+
+    result = observable(dataset)
+
+    assert isinstance(result, xr.Dataset)
+    assert result.attrs == dataset.attrs
+    assert result['var'].dtype == observable(data).dtype
+    assert np.array_equal(result['var'].values, observable(data))
+
+
+def test_observables_Dataset_dask():
+    pytest.importorskip('dask')
+
+    data = np.random.RandomState(0).normal(2, 3, size=(1000, 2)).astype(np.float32)
+    dataset = xr.Dataset({'var': (('time_step', 'node'), data)}).chunk({'time_step': 100})
+    observable = observables.Exceed([2.], [0.9], observables.Energy())
+
+    assert np.array_equal(observable(dataset)['var'].values, observable(data))
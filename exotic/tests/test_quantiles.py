@@ -0,0 +1,91 @@
+import pytest
+import numpy as np
+from lab import quantiles
+
+
+def test_HistogramSketch(tmp_path):
+
+    values = np.random.RandomState(0).normal(0, 3, size=100000)
+    orders = np.arange(0.01, 1, 0.01)
+
+    sketch_a = quantiles.HistogramSketch(-20, 20, bins=2 ** 16)
+    sketch_b = quantiles.HistogramSketch(-20, 20, bins=2 ** 16)
+    for batch in np.array_split(values[:50000], 10):
+        sketch_a.update(batch)
+    sketch_b.update(values[50000:])
+
+    sketch_b.save(str(tmp_path / 'sketch.npz'))
+    sketch_a.merge(quantiles.HistogramSketch.load(str(tmp_path / 'sketch.npz')))
+
+    assert sketch_a.count == len(values)
+    assert np.allclose(sketch_a.quantile(orders), np.quantile(values, orders), atol=2 * sketch_a.bin_width)
+    assert sketch_a.quantile(1) == values.max()
+
+
+def test_ExactQuantiles():
+
+    values = np.random.RandomState(0).normal(0, 3, size=10000).astype(np.float32)
+    orders = np.arange(0.01, 1, 0.01)
+
+    exact = quantiles.ExactQuantiles(size=1000)
+    for batch in np.array_split(values, 7):
+        exact.update(batch)
+
+    assert exact.count == len(values)
+    assert np.array_equal(exact.quantile(orders), np.quantile(values, orders))
+    assert np.array_equal(exact.quantile(orders), np.quantile(values, orders))
+
+
+def test_QuantileTable(tmp_path):
+
+    values = np.random.RandomState(0).normal(0, 3, size=(4, 10000))
+    orders = [0.1, 0.5, 0.9]
+
+    table = quantiles.QuantileTable(str(tmp_path))
+    for members in ([0, 1], [2, 3]):
+        sketch = quantiles.HistogramSketch(-20, 20, bins=2 ** 16)
+        sketch.update(values[members])
+        table.add_members('position', 'CF_8.0', sketch, members)
+        table.add_orders('position', 'CF_8.0', orders[:2])
+
+    with pytest.raises(ValueError):
+        table.add_members('position', 'CF_8.0', sketch, [3])
+
+    # reopened from disk; 0.9 is computed from the stored sketch, without writing to the table
+    entry_path = tmp_path / 'CF_8.0' / 'quantiles_position.npz'
+    mtime = entry_path.stat().st_mtime_ns
+    table = quantiles.QuantileTable(str(tmp_path))
+    result = [table.value('position', 'CF_8.0', order) for order in orders]
+    assert np.allclose(result, np.quantile(values, orders), atol=2 * sketch.bin_width)
+    assert table.members('position', 'CF_8.0').tolist() == [0, 1, 2, 3]
+    assert len(table.to_dataarray('position', 'CF_8.0')) == 2
+    assert entry_path.stat().st_mtime_ns == mtime
+    assert sorted(path.name for path in entry_path.parent.iterdir()) == ['quantiles_position.npz']
+
+
+def test_QuantileTable_sources(tmp_path):
+
+    values = np.random.RandomState(0).normal(0, 3, size=(2, 1000))
+    table = quantiles.QuantileTable(str(tmp_path))
+
+    table.set_values('position', 'CF_8.0', [0.5], np.quantile(values, [0.5]), members=[0, 1])
+    table.set_values('position', 'CF_8.0', [0.9], np.quantile(values, [0.9]), members=[1, 0])
+    assert table.source('position', 'CF_8.0') == 'values'
+    assert table.members('position', 'CF_8.0').tolist() == [0, 1]
+
+    # exact values are neither replaced by a sketch nor mixed with values over other members
+    sketch = quantiles.HistogramSketch(-20, 20)
+    sketch.update(values)
+    with pytest.raises(ValueError):
+        table.add_members('position', 'CF_8.0', sketch, [2])
+    with pytest.raises(ValueError):
+        table.set_values('position', 'CF_8.0', [0.1], [0.], members=[2])
+
+    table.add_members('energy', 'CF_8.0', sketch, [0, 1])
+    with pytest.raises(ValueError):
+        table.set_values('energy', 'CF_8.0', [0.5], [0.], members=[0, 1])
+
+    table = quantiles.QuantileTable(str(tmp_path))
+    assert table.source('position', 'CF_8.0') == 'values'
+    assert table.source('energy', 'CF_8.0') == 'sketch'
+    assert table.value('position', 'CF_8.0', 0.9) == np.quantile(values, 0.9)
@@ -0,0 +1,63 @@
+import numpy as np
+import netCDF4 as nc
+from lab import response
+from lab.simulation import observables
+
+
+def test_RunningStats_matches_numpy():
+
+    samples = np.random.RandomState(0).normal(3, 2, size=(1000, 50, 2))
+    samples[7, 3, 1] = np.nan
+
+    running_stats = response.RunningStats()
+    for start in range(0, 1000, 64):
+        running_stats.update(samples[start:start + 64])
+
+    assert np.allclose(running_stats.mean, np.nanmean(samples, axis=0))
+    assert np.allclose(running_stats.variance, np.nanvar(samples, axis=0, ddof=1))
+    assert running_stats.count[3, 1] == 999
+
+
+def write_member(path, data):
+
+    with nc.Dataset(path, 'w') as dataset:
+        dataset.createDimension('node', data.shape[1])
+        dataset.createDimension('time_step', None)
+        dataset.createVariable('time_step', np.int32, ('time_step',))[:] = np.arange(len(data))
+        dataset.createVariable('var', np.float32, ('time_step', 'node'))[:] = data
+
+
+def test_ResponseEstimator(tmp_path, monkeypatch):
+
+    random_state = np.random.RandomState(1)
+    forced = random_state.normal(size=(5, 20, 1)).astype(np.float32)
+    unforced = random_state.normal(size=(5, 20, 1)).astype(np.float32)
+
+    forced_paths, unforced_paths = [], []
+    for member in range(5):
+        forced_paths.append(str(tmp_path / 'forced_{}.nc'.format(member)))
+        unforced_paths.append(str(tmp_path / 'unforced_{}.nc'.format(member)))
+        write_member(forced_paths[-1], forced[member])
+        write_member(unforced_paths[-1], unforced[member])
+
+    read_var = response.read_var
+    reads = []
+
+    def counting_read_var(path):
+        reads.append(path)
+        return read_var(path)
+
+    monkeypatch.setattr(response, 'read_var', counting_read_var)
+
+    estimator = response.ResponseEstimator(observables.Energy(), block_members=2)
+    estimator.update(forced_paths, unforced_paths)
+    result = estimator.to_dataset()
+
+    # each file is read once
+    assert sorted(reads) == sorted(forced_paths + unforced_paths)
+
+    expected = 0.5 * forced.astype(np.float64) ** 2 - 0.5 * unforced.astype(np.float64) ** 2
+    assert np.allclose(result['mean'].values, expected.mean(axis=0), atol=1e-6)
+    assert np.allclose(result['variance'].values, expected.var(axis=0, ddof=1), atol=1e-6)
+    assert (result['lower'].values <= result['mean'].values).all()
+    assert (result['count'].values == 5).all()
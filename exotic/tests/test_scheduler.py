@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import xarray as xr
+
+from lab.simulation import scheduler
+
+
+def test_EnsembleScheduler(tmp_path):
+
+    initial_conditions = xr.DataArray(
+        np.random.RandomState(0).normal(8, 1, size=(50, 8)),
+        dims=('time_step', 'node'),
+        coords={'time_step': np.arange(50), 'node': np.arange(8)},
+        attrs={'integration_step': 0.01},
+    )
+    initial_conditions_path = str(tmp_path / 'init.nc')
+    initial_conditions.to_netcdf(initial_conditions_path)
+
+    ensemble = scheduler.EnsembleScheduler(
+        forcing_id='constant',
+        forcing_params=['8.0'],
+        initial_conditions_path=initial_conditions_path,
+        time_between_init_cond=0.1,
+        integration_time=1,
+        write_one_every=0.1,
+        write_all_every=0.5,
+        data_base_path=str(tmp_path),
+        chunk_length_time=1,
+        engine='python',
+        max_workers=2,
+    )
+
+    members = [0, 1, 2]
+    results = ensemble.run(members)
+
+    assert sorted(results) == members
+    for member, outfiles in results.items():
+        assert outfiles == ensemble.build_runner().outfile_paths(str(tmp_path), ensemble.member_suffix(member))
+        assert all(os.path.exists(outfile) for outfile in outfiles.values())
+        assert ensemble.is_complete(member)
+
+    done = []
+    results = ensemble.run(members + [3], callback=lambda member, result, error: done.append((member, result)))
+
+    assert results[3] is not None
+    assert sorted(done) == [(0, None), (1, None), (2, None), (3, results[3])]
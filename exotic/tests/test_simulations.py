@@ -1,6 +1,16 @@
+import os
 import pytest
 import numpy as np
+import netCDF4 as nc
+from lab import response
+from lab.simulation import backends
 from lab.simulation import simulation
+from lab.simulation import systems
+from lab.simulation import engines
+from lab.simulation import forcings
+from lab.simulation import integrators
+from lab.simulation import observables
+from lab.simulation import observers
 
 
 def toy_system(x, forcing):
@@ -17,7 +27,7 @@ def toy_system(x, forcing):
 ])
 def test_runge_kutta_4(input_coord, input_forcing, input_system, input_increment, expected):
 
-    result = simulation.runge_kutta_4(input_coord, input_forcing, input_system, input_increment)
+    result = integrators.RungeKutta4()(input_coord, input_forcing, input_system, input_increment)
 
     assert all([a == b for a, b in zip(result, expected)])
 
@@ -30,13 +40,48 @@ def test_runge_kutta_4(input_coord, input_forcing, input_system, input_increment
 ])
 def test_lorenz_96(input_coord, input_forcing, expected):
 
-    result = simulation.lorenz_96(input_coord, input_forcing)
+    result = systems.Lorenz96()(input_coord, input_forcing)
 
     print(result)
 
     assert all([a == b for a, b in zip(result, expected)])
 
 
+def test_lorenz_96_out():
+
+    input_coord = np.arange(1., 9.).reshape(2, 4)
+    out = np.empty_like(input_coord)
+    result = systems.Lorenz96()(input_coord, 8, out=out)
+
+    assert result is out
+    assert np.array_equal(out, systems.Lorenz96()(input_coord, 8))
+
+
+def test_lorenz_96_matches_loop():
+
+    x = np.random.RandomState(0).normal(size=32)
+
+    result = systems.Lorenz96()(x, 8)
+    expected = systems.Lorenz96Loop()(x, 8)
+
+    assert np.array_equal(result, expected)
+
+
+@pytest.mark.parametrize("forcing", [
+    forcings.ConstantForcing(8),
+    forcings.DeltaForcing(0.5, 8, 1),
+    forcings.StepForcing(1, 8, 0.5),
+    forcings.LinearForcing(1, 50, 8, 0.01),
+    forcings.SinusoidalForcing(1, 50, 8, 1, 0.3),
+])
+def test_forcing_evaluate(forcing):
+
+    times = np.round(np.arange(0, 10000) * 0.01, 2)
+    expected = [forcing(time) for time in times]
+
+    assert np.allclose(forcing.evaluate(times), expected, rtol=0, atol=1e-12)
+
+
 def test_SystemState_repr():
 
     point = simulation.SystemState(coords=[1, 2, 3], time=2)
@@ -54,3 +99,396 @@ def test_SystemState_energy():
     assert result == expected
 
 
+def test_Simulator_step_counter():
+
+    simulator = simulation.Simulator(
+        system_state=simulation.SystemState(coords=np.full(8, 8.) + np.eye(8)[0]),
+        increment=0.001,
+    )
+    simulator.integrate(0.5)
+    for _ in range(3):
+        simulator.integrate_one_step()
+
+    assert simulator.system_state.step == 503
+    assert simulator.system_state.time == 0.503
+
+
+def test_EnsembleSimulator_matches_members():
+
+    coords = np.random.RandomState(0).normal(8, 1, size=(3, 8))
+
+    ensemble = simulation.EnsembleSimulator(system_state=simulation.SystemState(coords=coords.copy()))
+    ensemble.integrate(0.5)
+
+    for member in range(3):
+        simulator = simulation.Simulator(system_state=simulation.SystemState(coords=coords[member].copy()))
+        simulator.integrate(0.5)
+        assert np.array_equal(ensemble.system_state.coords[member], simulator.system_state.coords)
+
+
+@pytest.mark.parametrize("shape", [(8,), (3, 8)])
+def test_engines_match_step_loop(shape):
+
+    coords = np.random.RandomState(0).normal(8, 1, size=shape)
+    forcing = forcings.LinearForcing(linear_coefficient=0.1)
+
+    reference = simulation.Simulator(system_state=simulation.SystemState(coords=coords.copy()), forcing=forcing)
+    for _ in range(50):
+        reference.integrate_one_step()
+
+    for engine in (engines.PythonEngine(), engines.get_engine('auto')):
+        simulator = simulation.Simulator(
+            system_state=simulation.SystemState(coords=coords.copy()),
+            forcing=forcing,
+            engine=engine
+        )
+        buffer = np.empty((5,) + shape[:-1] + (1,))
+        simulator.integrate_sampled(50, [(buffer, 10)])
+
+        assert np.array_equal(simulator.system_state.coords, reference.system_state.coords)
+        assert simulator.system_state.time == reference.system_state.time
+        assert buffer[0, ..., 0].tolist() == coords[..., 0].tolist()
+
+
+@pytest.mark.parametrize("shape", [(8,), (3, 8)])
+def test_engines_forcing_chunks(shape, monkeypatch):
+
+    coords = np.random.RandomState(0).normal(8, 1, size=shape)
+    forcing = forcings.LinearForcing(linear_coefficient=0.1)
+
+    for engine in (engines.PythonEngine(), engines.get_engine('auto')):
+        results = []
+        for chunk_steps in (engines.FORCING_CHUNK_STEPS, 7):
+            monkeypatch.setattr(engines, 'FORCING_CHUNK_STEPS', chunk_steps)
+            simulator = simulation.Simulator(
+                system_state=simulation.SystemState(coords=coords.copy(), step=3),
+                forcing=forcing,
+                engine=engine
+            )
+            samplers = [(np.empty((5,) + shape[:-1] + (2,)), 10), (np.empty((13,) + shape[:-1] + (1,)), 4)]
+            simulator.integrate_sampled(50, samplers, first_step=3)
+            simulator.integrate(0.2)
+            results.append([simulator.system_state.coords] + [buffer for buffer, _ in samplers])
+
+        for unchunked, chunked in zip(*results):
+            assert np.array_equal(unchunked, chunked)
+
+
+def test_runge_kutta_4_in_place():
+
+    x = np.random.RandomState(0).normal(8, 1, size=(3, 32))
+    int_method = integrators.RungeKutta4InPlace()
+
+    expected = integrators.RungeKutta4()(x, 8, systems.Lorenz96(), 0.01)
+    result = int_method(x.copy(), 8, systems.Lorenz96(), 0.01)
+    out = x.copy()
+    int_method(out, 8, systems.Lorenz96(), 0.01, out=out)
+
+    assert np.array_equal(result, expected)
+    assert np.array_equal(out, expected)
+
+
+def test_Simulator_in_place_state():
+
+    coords = np.random.RandomState(0).normal(8, 1, size=(2, 8))
+    int_method = integrators.RungeKutta4InPlace()
+    simulators = [
+        simulation.Simulator(system_state=simulation.SystemState(coords=coords[member].copy()), int_method=int_method)
+        for member in range(2)
+    ]
+    references = [
+        simulation.Simulator(system_state=simulation.SystemState(coords=coords[member].copy())) for member in range(2)
+    ]
+
+    # one integration method shared by interleaved simulators
+    states = []
+    for _ in range(3):
+        for simulator, reference in zip(simulators, references):
+            simulator.integrate(0.1)
+            simulator.integrate_one_step()
+            reference.integrate(0.1)
+            reference.integrate_one_step()
+            states.append((simulator.system_state.coords, reference.system_state.coords.copy()))
+
+    # states kept by the caller are not overwritten by later steps
+    for state, expected in states:
+        assert np.array_equal(state, expected)
+
+
+def test_SimulationRunner_records(tmp_path):
+
+    simulator = simulation.Simulator(system_state=simulation.SystemState(coords=np.full(8, 8.) + np.eye(8)[0]))
+    runner = simulation.SimulationRunner(
+        simulator=simulator,
+        integration_time=3,
+        chunk_length_time=0.5,
+        write_all_every=1,
+        write_one_every=0.25,
+    )
+
+    outfiles = runner.run(data_base_path=str(tmp_path), custom_suffix='test')
+
+    for key, records in runner.expected_records().items():
+        with nc.Dataset(outfiles[key]) as dataset:
+            assert dataset.variables['time_step'][:].tolist() == \
+                list(range(0, 300, runner._outputs()[key][0]))
+            assert len(dataset.variables['var']) == records
+
+
+@pytest.mark.parametrize("options, chunking, filters, unlimited", [
+    ({}, None, {'zlib': False, 'shuffle': False}, True),
+    ({'chunk_time': 4, 'zlib': True, 'complevel': 1}, [4, 8], {'zlib': True, 'shuffle': True, 'complevel': 1}, True),
+    ({'chunk_time': 100, 'chunk_nodes': 2, 'zlib': True, 'shuffle': False, 'fixed_length': True}, [12, 2],
+     {'zlib': True, 'shuffle': False, 'complevel': 4}, False),
+])
+def test_NetCDFBackend_layout(tmp_path, options, chunking, filters, unlimited):
+
+    runner = simulation.SimulationRunner(
+        simulator=simulation.Simulator(system_state=simulation.SystemState(coords=np.full(8, 8.) + np.eye(8)[0])),
+        integration_time=3,
+        chunk_length_time=0.5,
+        write_all_every=0.25,
+        backend=backends.NetCDFBackend(**options),
+    )
+    outfiles = runner.run(data_base_path=str(tmp_path), custom_suffix='test')
+
+    with nc.Dataset(outfiles['all']) as dataset:
+        var = dataset.variables['var']
+        if chunking is None:
+            # chunk sizes picked by the library (variables along unlimited dimensions are always chunked)
+            assert var.chunking() != 'contiguous'
+        else:
+            assert var.chunking() == chunking
+        for key, value in filters.items():
+            assert var.filters()[key] == value
+        assert dataset.dimensions['time_step'].isunlimited() == unlimited
+        assert len(dataset.dimensions['time_step']) == runner.expected_records()['all']
+        assert np.array_equal(dataset.variables['time_step'][:], np.arange(12) * 25)
+
+
+def test_SimulationRunner_zarr(tmp_path):
+
+    pytest.importorskip('zarr')
+
+    def build_runner(backend):
+        return simulation.SimulationRunner(
+            simulator=simulation.Simulator(system_state=simulation.SystemState(coords=np.full(8, 8.) + np.eye(8)[0])),
+            integration_time=3,
+            chunk_length_time=0.5,
+            write_all_every=1,
+            write_one_every=0.25,
+            backend=backend,
+        )
+
+    outfiles = build_runner(backends.NetCDFBackend()).run(data_base_path=str(tmp_path), custom_suffix='test')
+    runner = build_runner(backends.ZarrBackend(chunk_time=4))
+    outfiles_zarr = runner.run(data_base_path=str(tmp_path), custom_suffix='test')
+
+    for key, records in runner.expected_records().items():
+        assert outfiles_zarr[key].endswith('.zarr')
+        assert runner.backend.records(outfiles_zarr[key]) == records
+        assert np.array_equal(response.read_time_steps(outfiles_zarr[key]), response.read_time_steps(outfiles[key]))
+        assert np.array_equal(response.read_var(outfiles_zarr[key]), response.read_var(outfiles[key]))
+
+
+def test_ZarrBackend_chunks(tmp_path):
+
+    zarr = pytest.importorskip('zarr')
+
+    # chunks larger than the dimensions are clamped to them, as with NetCDFBackend
+    backends.ZarrBackend(chunk_time=100, chunk_nodes=64).create(str(tmp_path / 'out.zarr'), 8, 10, {}).close()
+
+    assert zarr.open_group(str(tmp_path / 'out.zarr'), mode='r')['var'].chunks == (10, 8)
+
+
+def test_SimulationRunner_background_write(tmp_path):
+
+    def build_runner(**kwargs):
+        return simulation.SimulationRunner(
+            simulator=simulation.Simulator(system_state=simulation.SystemState(coords=np.full(8, 8.) + np.eye(8)[0])),
+            integration_time=3,
+            chunk_length_time=0.5,
+            write_all_every=1,
+            write_one_every=0.25,
+            **kwargs
+        )
+
+    outfiles = build_runner().run(data_base_path=str(tmp_path / 'sync'), custom_suffix='test')
+    outfiles_background = build_runner(background_write=True, write_queue_size=2).run(
+        data_base_path=str(tmp_path / 'background'), custom_suffix='test'
+    )
+
+    for key in outfiles:
+        with nc.Dataset(outfiles[key]) as dataset, nc.Dataset(outfiles_background[key]) as dataset_background:
+            for name in ('time_step', 'var'):
+                assert np.array_equal(dataset.variables[name][:], dataset_background.variables[name][:])
+
+    # an error of the integration is raised, not that of a failed write
+    runner = build_runner(background_write=True)
+    integrate_sampled = runner.simulator.integrate_sampled
+    calls = []
+
+    def failing_integrate_sampled(*args, **kwargs):
+        calls.append(None)
+        if len(calls) == 2:
+            raise ValueError('integration')
+        integrate_sampled(*args, **kwargs)
+
+    def failing_write(*args):
+        raise OSError('write')
+
+    runner.simulator.integrate_sampled = failing_integrate_sampled
+    runner._write_records = failing_write
+    with pytest.raises(ValueError):
+        runner.run(data_base_path=str(tmp_path / 'failed'), custom_suffix='test')
+
+
+def test_SimulationRunner_resume(tmp_path):
+
+    coords = np.full((2, 8), 8.) + np.eye(2, 8)
+    step_forcings = [forcings.ConstantForcing(8.0), forcings.StepForcing(0, 8, 1)]
+
+    def build_runner(index=(0, 1)):
+        return simulation.SimulationRunner(
+            simulator=simulation.EnsembleSimulator(
+                system_state=simulation.SystemState(coords=coords.copy()),
+                forcing=forcings.MemberForcing(step_forcings, index),
+            ),
+            integration_time=3,
+            chunk_length_time=0.5,
+            write_all_every=0.5,
+            write_one_every=0.1,
+            checkpoint_every=1,
+        )
+
+    outfiles = build_runner().run(data_base_path=str(tmp_path / 'full'), custom_suffix=['a', 'b'])
+
+    def run_interrupted(chunks, **kwargs):
+        # interrupted after **chunks** chunks
+        runner = build_runner()
+        integrate_sampled = runner.simulator.integrate_sampled
+        calls = []
+
+        def interrupted_integrate_sampled(*args, **kwargs):
+            calls.append(None)
+            if len(calls) == chunks + 1:
+                raise KeyboardInterrupt
+            integrate_sampled(*args, **kwargs)
+
+        runner.simulator.integrate_sampled = interrupted_integrate_sampled
+        with pytest.raises(KeyboardInterrupt):
+            runner.run(data_base_path=str(tmp_path / 'resumed'), custom_suffix=['a', 'b'], **kwargs)
+
+        return runner
+
+    runner = run_interrupted(3)
+    checkpoint_path = runner.checkpoint_path(runner.outfile_paths(str(tmp_path / 'resumed'), 'a', 0))
+    assert os.path.exists(checkpoint_path)
+
+    # a fresh run removes the checkpoint of the previous one before recreating the files
+    run_interrupted(0)
+    assert not os.path.exists(checkpoint_path)
+
+    run_interrupted(3)
+
+    # same short name and first member, other forcing of the second member
+    with pytest.raises(ValueError):
+        build_runner(index=(0, 0)).run(data_base_path=str(tmp_path / 'resumed'), custom_suffix=['a', 'b'], resume=True)
+
+    outfiles_resumed = build_runner().run(
+        data_base_path=str(tmp_path / 'resumed'), custom_suffix=['a', 'b'], resume=True
+    )
+
+    for member, member_resumed in zip(outfiles, outfiles_resumed):
+        for key in member:
+            with nc.Dataset(member[key]) as dataset, nc.Dataset(member_resumed[key]) as dataset_resumed:
+                for name in ('time_step', 'var'):
+                    assert np.array_equal(dataset.variables[name][:], dataset_resumed.variables[name][:])
+
+
+def test_SimulationRunner_observers(tmp_path):
+
+    coords = np.full((3, 8), 8.) + np.eye(3, 8)
+    energy = observables.Energy()
+    accumulators = [observers.ObservableAccumulator(energy, output=output) for output in ('one', 'all')]
+
+    def build_runner(**kwargs):
+        return simulation.SimulationRunner(
+            simulator=simulation.EnsembleSimulator(system_state=simulation.SystemState(coords=coords.copy())),
+            integration_time=2,
+            chunk_length_time=0.5,
+            write_all_every=0.1,
+            write_one_every=0.05,
+            **kwargs
+        )
+
+    outfiles = build_runner().run(data_base_path=str(tmp_path), custom_suffix=['a', 'b', 'c'])
+    assert build_runner(observers=accumulators, write_output=False).run(
+        data_base_path=str(tmp_path / 'none'), custom_suffix=['a', 'b', 'c']
+    ) == [{}, {}, {}]
+    assert not (tmp_path / 'none').exists()
+
+    for accumulator in accumulators:
+        records = []
+        for member in outfiles:
+            with nc.Dataset(member[accumulator.output]) as dataset:
+                records.append(dataset['var'][:])
+        records = np.stack(records)
+        result = accumulator.to_dataset()
+        assert np.allclose(result['mean'].values, energy(records).mean(axis=0))
+        assert (result['count'].values == 3).all()
+
+
+@pytest.mark.parametrize("engine", ['python', 'auto'])
+def test_PairedSimulator_response(engine):
+
+    initial_conditions = np.full((3, 8), 8.) + np.eye(3, 8)
+    forcing = forcings.StepForcing(0, 8, 0.5)
+    accumulator = observers.ResponseAccumulator(observables.Position())
+
+    runner = simulation.SimulationRunner(
+        simulator=simulation.PairedSimulator(
+            system_state=simulation.SystemState(coords=initial_conditions.copy()),
+            forcing=forcing,
+            engine=engines.get_engine(engine),
+        ),
+        integration_time=2,
+        chunk_length_time=0.5,
+        write_one_every=0.05,
+        observers=[accumulator],
+        write_output=False,
+    )
+    assert runner.run() == [{}] * 6
+
+    records = {}
+    for key, member_forcing in (('forced', forcing), ('control', forcings.ConstantForcing(8.0))):
+        ensemble = simulation.EnsembleSimulator(
+            system_state=simulation.SystemState(coords=initial_conditions.copy()),
+            forcing=member_forcing,
+        )
+        records[key] = np.empty((40, 3, 1))
+        ensemble.integrate_sampled(200, [(records[key], 5)])
+
+    # from the float64 state
+    expected = (records['forced'] - records['control']).mean(axis=1)
+    assert np.allclose(accumulator.to_dataset()['mean'].values, expected, rtol=0, atol=1e-12)
+
+
+def test_PairedSimulator_outfiles(tmp_path):
+
+    forcing = forcings.StepForcing(0, 8, 0.5)
+    runner = simulation.SimulationRunner(
+        simulator=simulation.PairedSimulator(
+            system_state=simulation.SystemState(coords=np.full((2, 8), 8.) + np.eye(2, 8)),
+            forcing=forcing,
+        ),
+        integration_time=1,
+        chunk_length_time=0.5,
+        write_one_every=0.05,
+    )
+    outfiles = runner.run(data_base_path=str(tmp_path), custom_suffix=['a', 'b', 'a', 'b'])
+
+    for member, short_name in enumerate([forcing.short_name] * 2 + ['CF_8.0'] * 2):
+        assert os.path.basename(outfiles[member]['one']).startswith(f'sim_lorenz96_rk4_{short_name}_')
+        with nc.Dataset(outfiles[member]['one']) as dataset:
+            assert dataset.variables['var'].forcing == runner._forcing(member).long_name